@@ -161,7 +161,7 @@ class ICanReadActivity(activity.Activity):
         self.scrolled_window.show()
         canvas = gtk.DrawingArea()
         width = gtk.gdk.screen_width()
-        height = int(gtk.gdk.screen_height() * 2.75)
+        height = gtk.gdk.screen_height()  # Page sizes it to fit the text
         canvas.set_size_request(width, height)
         self.scrolled_window.add_with_viewport(canvas)
         canvas.show()
@@ -431,7 +431,7 @@ class ICanReadActivity(activity.Activity):
         self.metadata['level'] = str(self._level)
 
     def _restore(self):
-        ''' Load up cards until we get to the page we stopped on. '''
+        ''' Go straight to the level and page we stopped on. '''
         if 'level' in self.metadata:
             level = int(self.metadata['level'])
             self._level = level
@@ -443,12 +443,12 @@ class ICanReadActivity(activity.Activity):
             except IndexError:
                 print "couldn't restore level %s" % (self.metadata['level'])
                 self._levels_combo.set_active(0)
-            self._page.page = 0
-            self._page.new_page()
+        self._page.page = 0
         if 'page' in self.metadata:
-            page = int(self.metadata['page'])
-            for _i in range(page):
-                self._next_page_cb()
+            self._page.page = int(self.metadata['page'])
+            if self._page.page > 0:
+                self._prev_page_button.set_icon('previous-letter')
+        self._page.new_page()
 
     def _get_levels(self, path):
         ''' Look for level files in lessons directory. '''
@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#Copyright (c) 2011 Walter Bender
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+'''
+Micro-benchmarks for the rendering paths used by page.py.
+
+    python benchmark.py [name ...]
+
+Run from the activity directory. With no names, every benchmark is run.
+'''
+
+import os
+import sys
+import codecs
+import timeit
+import random
+import shutil
+import tempfile
+
+from layout import TextLayout, GlyphTable, compile_phrase
+
+LESSON = os.path.join('lessons', 'es', 'nivel-1.csv')
+SOUNDS = os.path.join('sounds', 'es')
+
+# The tables page.py used before text was compiled into token streams
+ALPHABET = u"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz:.,' " + \
+    u'!ÑñáéíóúÁÉÍÓÚ'
+KERN = {'i': 0.5, 'I': 0.7, 'l': 0.5, 't': 0.7, 'T': 0.9, 'r': 0.7, 'm': 1.4,
+        'w': 1.3, "'": 0.4, 'M': 1.4, 'f': 0.7, 'W': 1.6, 'L': 0.9, 'j': 0.6,
+        'J': 0.7, 'c': 0.9, 'z': 0.9, 's': 0.8, 'U': 1.1, ' ':0.7, '.':0.5,
+        'y':0.8, 'O': 1.1, 'K': 1.1, 'A': 1.1, 'Ñ': 1.1, 'N': 1.1, 'Á': 1.1,
+        'Í': 0.7, 'Ó': 1.1, 'Ú': 1.1, 'Q': 1.1}
+
+# Screen geometry of an XO
+WIDTH = 1200
+SCALE = WIDTH / 240.
+LEAD = int(SCALE * 15)
+MARGIN = int(SCALE * 3)
+OFFSET = int(SCALE * 9)
+
+
+def read_lesson(path):
+    ''' [(phrase, n), ...] for the word lists of a level '''
+    phrases = []
+    f = codecs.open(path, encoding='utf-8')
+    for line in f:
+        if len(line) > 0 and line[0] not in '#\n':
+            words = line.split(', ')
+            if words[0] in '-+':
+                n = 1
+            else:
+                n = len(words[0])
+            for phrase in words[6].split('/'):
+                phrases.append((phrase, n))
+    f.close()
+    return phrases
+
+
+def _draw(*args):
+    ''' Stand-in for Page._draw_pixbuf '''
+    pass
+
+
+class LegacyRenderer():
+    ''' The per-character scan that Page._draw_a_word used to do '''
+
+    def __init__(self):
+        self.x, self.y = MARGIN, LEAD
+
+    def render_phrase(self, phrase, n):
+        lines = phrase.split('\\')
+        if len(lines) == 1:
+            for word in phrase.split():
+                if self.x + len(word) * OFFSET > WIDTH - MARGIN:
+                    self.x, self.y = 10, self.y + LEAD
+                self.draw_a_word(word, n)
+        else:
+            for line in lines:
+                self.draw_a_word(line, n)
+                self.x, self.y = 10, self.y + LEAD
+
+    def draw_a_word(self, word, n):
+        skip_count = 0
+        draw_in_color = False
+        kern_char = None
+        for char in range(len(word)):
+            if skip_count > 0:
+                skip_count -= 1
+            elif word[char] == '(' and not draw_in_color:
+                draw_in_color = True
+            elif word[char] == ')' and draw_in_color:
+                draw_in_color = False
+            elif draw_in_color:
+                _draw(word[char], self.x, self.y)
+                kern_char = word[char]
+                if n > 1:
+                    skip_count = n - 1
+            elif word[char] in ALPHABET:
+                _draw(ALPHABET.index(word[char]), self.x, self.y)
+                kern_char = word[char]
+            if word[char] not in '()':
+                if kern_char in KERN:
+                    self.x += OFFSET * KERN[kern_char]
+                else:
+                    self.x += OFFSET
+        if self.x > MARGIN:
+            self.x += int(OFFSET / 1.6)
+
+
+def _advance(char):
+    if char in KERN:
+        return OFFSET * KERN[char]
+    return OFFSET
+
+
+def bench_phrases(repeat=5):
+    ''' Per-phrase cost of laying out and painting the level word lists '''
+    phrases = read_lesson(LESSON)
+    letters = sum([len(phrase) for phrase, n in phrases])
+
+    def before():
+        renderer = LegacyRenderer()
+        for phrase, n in phrases:
+            renderer.render_phrase(phrase, n)
+
+    table = GlyphTable()
+    compiled = [compile_phrase(phrase, table, _advance, n)
+                for phrase, n in phrases]
+    layout = TextLayout(WIDTH, MARGIN, LEAD, OFFSET)
+
+    def after():
+        x, y = MARGIN, LEAD
+        for phrase in compiled:
+            runs, x, y = layout.phrase(phrase, x, y, 0)
+            for run in runs:
+                for dx, glyph, color in run.glyphs:
+                    _draw(glyph, run.x + dx, run.y)
+
+    print 'phrases: %d phrases, %d characters from %s' % (
+        len(phrases), letters, LESSON)
+    for name, fn in (('character scan', before), ('token streams', after)):
+        t = min(timeit.repeat(fn, number=10, repeat=repeat)) / 10
+        print '  %-16s %8.1f us/phrase' % (name, t * 1e6 / len(phrases))
+
+
+def _offscreen_sprites():
+    ''' A Sprites collection drawing to an offscreen pixmap, or None if
+    there is no display to draw with. '''
+    try:
+        import gtk
+        from utils.sprites import Sprites
+        area = gtk.gdk.Pixmap(None, WIDTH, WIDTH, 24)
+    except (ImportError, RuntimeError, TypeError):
+        print '  skipped: needs gtk and a display'
+        return None
+    return Sprites(None, area, area.new_gc())
+
+
+def _letter_pixbuf():
+    ''' A letter-sized pixbuf with an opaque middle '''
+    import gtk
+    pixbuf = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, True, 8, 80, 60)
+    pixbuf.fill(0x00000000)
+    pixbuf.subpixbuf(20, 10, 40, 40).fill(0x000000ff)
+    return pixbuf
+
+
+def _linear_find_sprite(sprites, pos):
+    ''' How Sprites.find_sprite used to search: every sprite, top down '''
+    list = sprites.list[:]
+    list.reverse()
+    for spr in list:
+        if spr.hit(pos):
+            if spr.get_pixel(pos)[3] == 255:
+                return spr
+    return None
+
+
+def bench_find_sprite(counts=(50, 100, 200, 400, 800), presses=200):
+    ''' Button press latency against the number of sprites '''
+    print 'find_sprite: us per press'
+    sprites = _offscreen_sprites()
+    if sprites is None:
+        return
+    from utils.sprites import Sprite
+    pixbuf = _letter_pixbuf()
+    random.seed(1)
+    positions = [(random.randrange(WIDTH), random.randrange(WIDTH))
+                 for i in range(presses)]
+
+    def linear():
+        for pos in positions:
+            _linear_find_sprite(sprites, pos)
+
+    def indexed():
+        for pos in positions:
+            sprites.find_sprite(pos)
+
+    print '  %8s %10s %10s' % ('sprites', 'linear', 'indexed')
+    for count in counts:
+        while len(sprites.list) < count:
+            spr = Sprite(sprites, random.randrange(WIDTH - 80),
+                         random.randrange(WIDTH - 60), pixbuf)
+            spr.set_layer(random.randrange(1, 4))
+        t = [min(timeit.repeat(fn, number=1, repeat=3)) / presses
+             for fn in (linear, indexed)]
+        print '  %8d %10.1f %10.1f' % (count, t[0] * 1e6, t[1] * 1e6)
+
+
+class LegacySprite():
+    ''' The attributes Sprite.__init__ used to allocate for every sprite '''
+
+    def __init__(self, sprites, x, y, image):
+        import gtk
+        self._sprites = sprites
+        self.rect = gtk.gdk.Rectangle(int(x), int(y), 0, 0)
+        self._scale = [12]
+        self._rescale = [True]
+        self._horiz_align = ["center"]
+        self._vert_align = ["middle"]
+        self._fd = None
+        self._bold = False
+        self._italic = False
+        self._color = None
+        self._margins = [0, 0, 0, 0]
+        self.layer = 100
+        self.sequence = 0
+        self.cells = []
+        self._hit_mask = None
+        self.labels = []
+        self.images = [image]
+        self._dx = [0]
+        self._dy = [0]
+        self.rect.width = image.get_width()
+        self.rect.height = image.get_height()
+
+
+def _footprint(obj):
+    ''' Bytes held by an object, its __dict__ and the containers in it '''
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+        values = obj.__dict__.values()
+    else:
+        values = [getattr(obj, name) for name in obj.__slots__
+                  if hasattr(obj, name)]
+    for value in values:
+        if isinstance(value, (list, tuple)):
+            size += sys.getsizeof(value)
+            for item in value:
+                if isinstance(item, (list, tuple)):
+                    size += sys.getsizeof(item)
+    return size
+
+
+def bench_sprite_size(count=1000):
+    ''' Memory per glyph-holder sprite and the time to make one '''
+    print 'sprite_size: %d sprites with one image and no label' % (count)
+    try:
+        import gtk
+        from utils.sprites import Sprite
+    except ImportError:
+        print '  skipped: needs gtk'
+        return
+    pixbuf = _letter_pixbuf()
+    print '  %-8s %10s %12s' % ('', 'bytes', 'us/sprite')
+    for name, cls in (('legacy', LegacySprite), ('slotted', Sprite)):
+        size = _footprint(cls(None, 0, 0, pixbuf))
+        t = min(timeit.repeat(lambda: cls(None, 0, 0, pixbuf),
+                              number=count, repeat=3)) / count
+        print '  %-8s %10d %12.2f' % (name, size, t * 1e6)
+
+
+def bench_sound_bank(repeat=5):
+    ''' Time to find and read every sound of a language, file by file and
+    from a sound bank '''
+    from utils.sound_bank import SoundBank, build
+    paths = [os.path.join(SOUNDS, name) for name in os.listdir(SOUNDS)
+             if name.endswith('.ogg')]
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'es.bank')
+        build(SOUNDS, filename)
+        print 'sound_bank: %d sounds from %s, %d bytes' % (
+            len(paths), SOUNDS, os.path.getsize(filename))
+
+        def files():
+            for path in paths:
+                if os.path.exists(path):
+                    f = open(path, 'rb')
+                    f.read()
+                    f.close()
+
+        def load():  # Once a session, checking the bank is up to date
+            SoundBank(SOUNDS, filename).load()
+
+        bank = SoundBank(SOUNDS, filename)
+        bank.load()
+
+        def get():
+            for path in paths:
+                bank.get(path)
+
+        t = min(timeit.repeat(load, number=10, repeat=repeat)) / 10
+        print '  %-12s %8.1f us/session' % ('bank load', t * 1e6)
+        for name, fn in (('files', files), ('bank', get)):
+            t = min(timeit.repeat(fn, number=10, repeat=repeat)) / 10
+            print '  %-12s %8.1f us/sound' % (name, t * 1e6 / len(paths))
+    finally:
+        shutil.rmtree(directory)
+
+
+BENCHMARKS = [('phrases', bench_phrases), ('find_sprite', bench_find_sprite),
+              ('sprite_size', bench_sprite_size),
+              ('sound_bank', bench_sound_bank)]
+
+
+def main(names):
+    for name, fn in BENCHMARKS:
+        if len(names) == 0 or name in names:
+            fn()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -15,6 +15,8 @@
 
 import os
 
+from xml.sax.saxutils import escape
+
 
 class SVG:
     ''' SVG generators '''
@@ -53,7 +55,7 @@ stroke:#000000;%s\">" % (font_size, self._stroke, align)
             svg_string += "style=\"font-size:%dpx;font-weight:bold;font-family:Sans;fill:%s;\
 %s\">" % (font_size, self._stroke, align)
         svg_string += "<tspan x=\"%d\" y=\"%d\">%s</tspan></text>" % \
-            (x, y, text_string)
+            (x, y, escape(text_string))
         return svg_string
 
     def _svg_line(self, x1, y1, x2, y2):
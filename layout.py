@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+#Copyright (c) 2011 Walter Bender
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import json
+
+from array import array
+from collections import namedtuple
+
+import logging
+_logger = logging.getLogger('infused-activity')
+
+# Token flags
+PLAIN, LOWER, UPPER, SKIP = range(4)
+
+# A compiled phrase: lines is True if each word is a whole line (the
+# phrase contained \\ line breaks).
+Phrase = namedtuple('Phrase', 'lines words')
+
+# A compiled word: glyphs and flags have one entry per character drawn;
+# offsets holds the prefix sums of their advances, so offsets[i] is where
+# glyph i is drawn and offsets[-1] is the width of the word.
+Word = namedtuple('Word', 'glyphs flags offsets')
+
+# A word (or a line drawn as a unit) positioned on the canvas. glyphs is a
+# tuple of (dx, glyph id, color): color is -1 for plain text, otherwise
+# 2 * page (+ 1 for upper case) names the colored letter drawn instead.
+Run = namedtuple('Run', 'x y width glyphs')
+
+
+class GlyphTable():
+    ''' Give each character a small integer id '''
+
+    def __init__(self):
+        self.chars = []
+        self._ids = {}
+
+    def id(self, char):
+        ''' The id for char, allocating one if need be '''
+        if char not in self._ids:
+            self._ids[char] = len(self.chars)
+            self.chars.append(char)
+        return self._ids[char]
+
+
+class AdvanceTable():
+    ''' The horizontal advance of each character in a font and size,
+    measured once and remembered on disk. '''
+
+    def __init__(self, measure, font, size, path=None):
+        ''' measure(char) returns the advance of char in pixels '''
+        self._measure = measure
+        self._advances = {}
+        self._dirty = False
+        if path is None:
+            self._filename = None
+        else:
+            self._filename = os.path.join(path, 'advances-%s-%d.json' % (
+                    font.replace(' ', '-'), size))
+            if os.path.exists(self._filename):
+                try:
+                    f = open(self._filename)
+                    self._advances = json.load(f)
+                    f.close()
+                except (IOError, ValueError):
+                    _logger.debug('ignoring bad advances %s', self._filename)
+
+    def get(self, char):
+        ''' The advance for char '''
+        if char not in self._advances:
+            self._advances[char] = self._measure(char)
+            self._dirty = True
+        return self._advances[char]
+
+    def save(self):
+        ''' Remember any newly measured characters '''
+        if self._filename is None or not self._dirty:
+            return
+        try:
+            f = open(self._filename + '.tmp', 'w')
+            json.dump(self._advances, f)
+            f.close()
+            os.rename(self._filename + '.tmp', self._filename)
+            self._dirty = False
+        except (IOError, OSError):
+            _logger.debug('failed to save advances %s', self._filename)
+
+
+def compile_phrase(phrase, table, advance, n=1):
+    ''' Tokenize a phrase once so that laying it out is a loop over
+    integers. Letters enclosed in () are highlighted; a highlight covers n
+    letters, the first drawn in color and the rest skipped. '''
+    lines = phrase.split('\\')
+    if len(lines) == 1:  # split a phrase into words
+        words = phrase.split()
+    else:  # each line is a unit
+        words = lines
+    return Phrase(len(lines) > 1, [_compile_word(word, table, advance, n)
+                                   for word in words])
+
+
+def _compile_word(word, table, advance, n):
+    ''' Tokenize each character in the word '''
+    glyphs = array('i')
+    flags = array('b')
+    offsets = array('f', [0])
+    width = 0
+    skip_count = 0
+    in_color = False
+    for c in word:
+        if skip_count > 0:
+            # some colored text is multiple characters
+            skip_count -= 1
+            flag = SKIP
+        elif c == '(' and not in_color:
+            in_color = True
+            continue
+        elif c == ')' and in_color:
+            in_color = False
+            continue
+        elif c in '()':
+            continue
+        elif in_color:
+            if c.islower():
+                flag = LOWER
+            else:
+                flag = UPPER
+            width = advance(c)
+            if n > 1:
+                skip_count = n - 1
+        else:
+            flag = PLAIN
+            width = advance(c)
+        glyphs.append(table.id(c))
+        flags.append(flag)
+        offsets.append(offsets[-1] + width)
+    return Word(glyphs, flags, offsets)
+
+
+class TextLayout():
+    ''' Position the glyphs of phrases. Painting is left to the caller. '''
+
+    def __init__(self, width, margin, lead, offset):
+        self._width = width
+        self._margin = margin
+        self._lead = lead
+        self._offset = offset
+
+    def phrase(self, phrase, x, y, page=-1):
+        ''' Lay out a compiled phrase starting at (x, y). Highlighted
+        letters are drawn in the colors of card page (if not -1).
+        Returns the list of runs and the position following the phrase. '''
+        runs = []
+        for word in phrase.words:
+            # Will line run off the right edge?
+            if not phrase.lines and \
+               x + word.offsets[-1] > self._width - self._margin:
+                x, y = self.newline(y)
+            run, x = self.word(word, x, y, page)
+            runs.append(run)
+            if phrase.lines:
+                x, y = self.newline(y)
+        return runs, x, y
+
+    def word(self, word, x, y, page=-1):
+        ''' Position each glyph in a compiled word. Returns the run and the
+        position of the next word. '''
+        glyphs = []
+        flags = word.flags
+        offsets = word.offsets
+        for i, glyph in enumerate(word.glyphs):
+            flag = flags[i]
+            if flag == PLAIN or page == -1:
+                glyphs.append((offsets[i], glyph, -1))
+            elif flag != SKIP:
+                glyphs.append((offsets[i], glyph, 2 * page + (flag == UPPER)))
+
+        run = Run(x, y, offsets[-1], tuple(glyphs))
+        x += offsets[-1]
+        # Put a space after each word
+        if x > self._margin:
+            x += int(self._offset / 1.6)
+        return run, x
+
+    def newline(self, y):
+        ''' The position of the next line, with left-justified alignment. '''
+        return 10, y + self._lead
+
+
+def translate(runs, dy):
+    ''' Move runs down by dy '''
+    return [Run(run.x, run.y + dy, run.width, run.glyphs) for run in runs]
@@ -12,15 +12,22 @@
 # Boston, MA 02111-1307, USA.
 
 import gtk
+import gobject
+import pango
 import os
 import codecs
+import time
+import bisect
+
+from collections import OrderedDict
 
 from gettext import gettext as _
 
 from random import randrange
 
 # from utils.gplay import play_audio_from_file, play_movie_from_file
-from utils.play_audio import play_audio_from_file
+from utils.play_audio import play_audio_from_file, play_samples, \
+    stop_audio
 from utils.play_video import play_movie_from_file
 
 import logging
@@ -33,16 +40,60 @@ except ImportError:
     GRID_CELL_SIZE = 0
 
 from genpieces import generate_card
-from utils.sprites import Sprites, Sprite
-
-# Rendering-related constants
-KERN = {'i': 0.5, 'I': 0.7, 'l': 0.5, 't': 0.7, 'T': 0.9, 'r': 0.7, 'm': 1.4,
-        'w': 1.3, "'": 0.4, 'M': 1.4, 'f': 0.7, 'W': 1.6, 'L': 0.9, 'j': 0.6,
-        'J': 0.7, 'c': 0.9, 'z': 0.9, 's': 0.8, 'U': 1.1, ' ':0.7, '.':0.5,
-        'y':0.8, 'O': 1.1, 'K': 1.1, 'A': 1.1, 'Ñ': 1.1, 'N': 1.1, 'Á': 1.1,
-        'Í': 0.7, 'Ó': 1.1, 'Ú': 1.1, 'Q': 1.1}
-ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz:.,' " + \
-    u'!ÑñáéíóúÁÉÍÓÚ'
+from layout import TextLayout, GlyphTable, AdvanceTable, compile_phrase, \
+    translate, LOWER, UPPER, SKIP
+from utils.sprites import Sprites, Sprite, SpritePool
+from utils.tiles import TiledCanvas
+from utils.glyph_cache import GlyphCache
+from utils.image_cache import ImageCache
+from utils.atlas import Atlas
+from utils.sound_cache import SoundCache, sequence
+from utils.sound_bank import SoundBank
+from utils.colorize import colorize, can_colorize
+
+# Rendering-related constants: the font genpieces draws letters in
+FONT = 'Sans Bold'
+# Where genpieces starts a (left-aligned) letter
+GLYPH_X = 5
+# Where two-tone letters switch to the second color
+SPLIT = 9 / 16.
+# Height of the tiles the text is painted on
+TILE_HEIGHT = 128
+# Bytes of painted tiles kept for the pages we have left
+SURFACE_BUDGET = 12 * 1024 * 1024
+# Seconds of work done by each idle-time prefetch slice
+PREFETCH_SLICE = 0.005
+# Colored letters kept for painting the list of pages we have left
+LIST_LETTERS = 64
+# Bytes of decoded sounds kept in memory
+SOUND_BUDGET = 8 * 1024 * 1024
+# Tiles painted per pass of the main loop by read and test
+RENDER_CHUNK = 2
+# Seconds of silence after each word, and after each phrase, read aloud
+WORD_PAUSE = 0.25
+PHRASE_PAUSE = 0.6
+# Milliseconds between checks that the sounds to read aloud are decoded
+SEQUENCE_POLL = 50
+# How many times to check before reading aloud whatever has been decoded
+SEQUENCE_TRIES = 100
+# Milliseconds between checks of which word is being read aloud
+HIGHLIGHT_TICK = 20
+# Seconds past the end of a reading after which we stop waiting for it
+READ_ALONG_MARGIN = 2
+# Behind the word being read aloud
+HIGHLIGHT = '#FFF080'
+
+
+def _render_pass(method):
+    ''' Batch the redraws of a page method into a single invalidation '''
+    def render_pass(self, *args):
+        self._begin_render()
+        try:
+            return method(self, *args)
+        finally:
+            self._end_render()
+    render_pass.__doc__ = method.__doc__
+    return render_pass
 
 
 class Page():
@@ -60,10 +111,9 @@ class Page():
         self._color_data = []
         self._image_data = []
         self._media_data = []  # (image sound, letter sound)
+        self._letter_sounds = {}  # letter: path of its sound
         self._word_data = []
 
-        _logger.debug(ALPHABET)
-
         # Starting from command line
         if self._activity is None:
             self._sugar = False
@@ -80,77 +130,107 @@ class Page():
         self._canvas.connect("button-press-event", self._button_press_cb)
         self._canvas.connect("button-release-event", self._button_release_cb)
         self._canvas.connect("key_press_event", self._keypress_cb)
+        # Rendered glyphs and their metrics are kept between sessions.
+        if self._sugar and hasattr(self._activity, 'datapath'):
+            self._cache_path = self._activity.datapath
+            self._glyphs = GlyphCache(card_to_pixbuf, os.path.join(
+                    self._cache_path, 'glyphs'))
+        else:
+            self._cache_path = None
+            self._glyphs = GlyphCache(card_to_pixbuf)
         self._width = gtk.gdk.screen_width()
         self._height = gtk.gdk.screen_height()
         self._scale = self._width / 240.
         self._sprites = Sprites(self._canvas)
+        self._level_sprites = SpritePool(self._sprites)  # cards and letters
         self.page = 0
-        self._cards = []
-        self._letters = []
-        self._colored_letters_lower = []
-        self._colored_letters_upper = []
+        self._cards = {}  # by page
+        self._glyph_table = GlyphTable()
+        self._letters = []  # by glyph id, rasterized as they are needed
+        self._colored_letters_lower = {}  # by page
+        self._colored_letters_upper = {}
         self._picture = None
+        self._prepared = {}  # page: [card, lower, upper] pixbufs
+        self._list_letters = OrderedDict()  # (page, upper): pixbuf, LRU
+        self._level_loads = 0  # which loading of a level is shown
+        self._reached = -1  # the furthest page shown: its letters are known
+        # Pictures come from a pre-scaled atlas, once it has been made.
+        if self._cache_path is not None:
+            w, h = self._picture_size()
+            self._images = ImageCache(atlas=Atlas(self._images_path, w, h,
+                                                  self._cache_path))
+        else:
+            self._images = ImageCache()
+        self._placeholder = None  # shown while a picture is loading
+        self._prefetch_id = None
         self._press = None
         self._release = None
         # self.gplay = None
         self.aplay = None
+        bank = SoundBank(self._sounds_path)
+        if not bank.load():
+            bank = None
+        self.sounds = SoundCache(SOUND_BUDGET, bank)
+        self._sequence = None  # [(sound paths, pause, run)] to read aloud
+        self._sequence_sounds = {}  # path: samples, as they are decoded
+        self._sequence_tries = 0
+        self._sequence_id = None
+        self._timeline = None  # [(start, end, run)] being read aloud
+        self._highlight_id = None
+        self._highlight_color = None
+        self._spoken = None  # the run being read aloud
+        self._late = []  # seconds each highlight came after its word
+        self._read_along_start = None  # time.time() when it was played
         self.vplay = None
-        self._final_x = 0
         self._lead = int(self._scale * 15)
         self._margin = int(self._scale * 3)
         self._left = self._margin  # int((self._width - self._scale * 60) / 2.)
-        self._x_pos = self._margin
-        self._y_pos = self._lead
         self._offset = int(self._scale * 9)  # self._width / 30.)
         self._looking_at_word_list = False
-
-        self._my_canvas = Sprite(self._sprites, 0, 0,
-                                gtk.gdk.Pixmap(self._canvas.window,
-                                               self._width,
-                                               int(self._height * 2.75), -1))
-        self._my_canvas.set_layer(0)
-        self._my_gc = self._my_canvas.images[0].new_gc()
-        self._my_gc.set_foreground(
-            self._my_gc.get_colormap().alloc_color('#FFFFFF'))
-
-        for c in ALPHABET:
-            self._letters.append(Sprite(self._sprites, 0, 0,
-                svg_str_to_pixbuf(generate_card(string=c,
-                                                colors=['#000000', '#000000'],
-                                                font_size=12 * self._scale,
-                                                background=False))))
+        self._render_depth = 0
+        self._render_id = None
+        self._pending = None  # the render to do on the next pass
+        self._chunk = None  # tiles to paint at a time (None for all)
+        self._more_tiles = False
+        self.renders = 0  # renders done
+        self.coalesced = 0  # renders replaced by a later one
+        self.cancelled = 0  # chunked renders abandoned part way
+        self._layout = TextLayout(self._width, self._margin, self._lead,
+                                  self._offset)
+        self._advances = AdvanceTable(self._measure, FONT,
+                                      int(12 * self._scale), self._cache_path)
+        self._compiled = {}  # (text, n): compiled phrase
+        self._layouts = {}  # (page, mode, width): runs
+
+        # The text is painted on tiles beneath the card and picture, and
+        # only where it can be seen.
+        self._runs = []
+        self._tiles = TiledCanvas(self._sprites, self._canvas.window,
+                                  self._width, TILE_HEIGHT, self._paint_tile,
+                                  budget=SURFACE_BUDGET)
+        if hasattr(self._activity, 'scrolled_window'):
+            vadj = self._activity.scrolled_window.get_vadjustment()
+            vadj.connect('value-changed', self._scroll_cb)
+            vadj.connect('changed', self._scroll_cb)
 
         self.load_level(os.path.join(self._lessons_path, level + '.csv'))
         self.new_page()
 
     def page_list(self):
+        ''' Index into all the cards in the form of a list of phrases '''
+        self._request(self._page_list)
+
+    @_render_pass
+    def _page_list(self):
         ''' Index into all the cards in the form of a list of phrases '''
         # Already here? Then jump back to current page.
         if self._looking_at_word_list:
-            self.new_page()
+            self._new_page()
             return
+        self._chunk = None
 
-        save_page = self.page
         self._clear_all()
-
-        rect = gtk.gdk.Rectangle(0, 0, self._width, int(self._height * 2.75))
-        self._my_canvas.images[0].draw_rectangle(self._my_gc, True, *rect)
-        self.invalt(0, 0, self._width, self._height)
-        self._my_canvas.set_layer(1)
-
-        self._x_pos, self._y_pos = self._margin, 0
-
-        # _logger.debug('%s' % (self.get_phrase_list()))
-        for i, phrase in enumerate(self.get_phrase_list()):
-            if i < len(self._colored_letters_lower):
-                self.page = i
-            else:
-                self.page = -1
-            self._render_phrase(phrase, self._my_canvas, self._my_gc)
-            self._x_pos = self._margin
-            self._y_pos += self._lead
-
-        self.page = save_page
+        self._paint_view('list')
         self._looking_at_word_list = True
 
     def get_phrase_list(self):
@@ -169,107 +249,179 @@ class Page():
 
     def new_page(self):
         ''' Load a new page: a card and a message '''
-        if self.page == len(self._word_data):
-            self.page = 0
+        # Wrap around now: taps may move the page on more than once
+        # before the render is done.
+        if len(self._word_data) > 0:
+            self.page %= len(self._word_data)
+        self._request(self._new_page)
+
+    @_render_pass
+    def _new_page(self):
+        ''' Load a new page: a card and a message '''
         if self._sugar:
             if self.page < len(self._card_data):
                 if hasattr(self._activity, 'sounds_combo'):
                     self._activity.sounds_combo.set_active(self.page)
-        if self.page == len(self._cards) and \
+        self._reached = max(self._reached, self.page)
+        # Cards are made when they are first needed, in any order.
+        if self.page not in self._cards and \
            self.page < len(self._card_data):
-            # Two-tone cards add some complexity.
-            if type(self._color_data[self.page][0]) == type([]):
-                stroke = self._test_for_stroke()
-                top = svg_str_to_pixbuf(generate_card(
-                        string=self._card_data[self.page][0].lower(),
-                        colors=[self._color_data[self.page][0][0], '#FFFFFF'],
-                        scale=self._scale,
-                        center=True))
-                bot = svg_str_to_pixbuf(generate_card(
-                        string=self._card_data[self.page][0].lower(),
-                        colors=[self._color_data[self.page][0][1], '#FFFFFF'],
-                        scale=self._scale,
-                        center=True))
-                # Where to draw the line
-                h1 = 9 / 16.
-                h2 = 1.0 - h1
-                bot.composite(top, 0, int(h1 * top.get_height()),
-                              top.get_width(), int(h2 * top.get_height()),
-                              0, 0, 1, 1, gtk.gdk.INTERP_NEAREST, 255)
-                self._cards.append(Sprite(self._sprites, # self._left,
-                    int(self._width - 320 * self._scale / 2.5),
-                                          GRID_CELL_SIZE, top))
-                top = svg_str_to_pixbuf(generate_card(
-                                string=self._card_data[self.page][0][0].lower(),
-                                colors=[self._color_data[self.page][0][0],
-                                        '#FFFFFF'],
-                                font_size=12 * self._scale,
-                                background=False, stroke=stroke))
-                bot = svg_str_to_pixbuf(generate_card(
-                                string=self._card_data[self.page][0][0].lower(),
-                                colors=[self._color_data[self.page][0][1],
-                                        '#FFFFFF'],
-                                font_size=12 * self._scale,
-                                background=False, stroke=stroke))
-                bot.composite(top, 0, int(h1 * top.get_height()),
-                              top.get_width(), int(h2 * top.get_height()),
-                              0, 0, 1, 1, gtk.gdk.INTERP_NEAREST, 255)
-                self._colored_letters_lower.append(Sprite(
-                        self._sprites, 0, 0, top))
-                top = svg_str_to_pixbuf(generate_card(
-                                string=self._card_data[self.page][0][0].upper(),
-                                colors=[self._color_data[self.page][0][0],
-                                        '#FFFFFF'],
-                                font_size=12 * self._scale,
-                                background=False, stroke=stroke))
-                bot = svg_str_to_pixbuf(generate_card(
-                                string=self._card_data[self.page][0][0].upper(),
-                                colors=[self._color_data[self.page][0][1],
-                                        '#FFFFFF'],
-                                font_size=12 * self._scale,
-                                background=False, stroke=stroke))
-                bot.composite(top, 0, int(h1 * top.get_height()),
-                              top.get_width(), int(h2 * top.get_height()),
-                              0, 0, 1, 1, gtk.gdk.INTERP_NEAREST, 255)
-                self._colored_letters_upper.append(Sprite(
-                        self._sprites, 0, 0, top))
-            else:
-                stroke = self._test_for_stroke()
-                self._cards.append(Sprite(self._sprites,
-                    int(self._width - 320 * self._scale / 2.5),
-                                          GRID_CELL_SIZE,
-                                          svg_str_to_pixbuf(generate_card(
-                                string=self._card_data[self.page][0].lower(),
-                                colors=[self._color_data[self.page][0],
-                                        '#FFFFFF'],
-                                stroke=stroke,
-                                scale=self._scale, center=True))))
-                self._colored_letters_lower.append(Sprite(
-                        self._sprites, 0, 0, svg_str_to_pixbuf(generate_card(
-                                string=self._card_data[self.page][0].lower(),
-                                colors=[self._color_data[self.page][0],
-                                        '#FFFFFF'],
-                                font_size=12 * self._scale,
-                                background=False, stroke=stroke))))
-                self._colored_letters_upper.append(Sprite(
-                        self._sprites, 0, 0, svg_str_to_pixbuf(generate_card(
-                                string=self._card_data[self.page][0].upper(),
-                                colors=[self._color_data[self.page][0],
-                                        '#FFFFFF'],
-                                font_size=12 * self._scale,
-                                background=False, stroke=stroke))))
+            self._cards[self.page] = self._level_sprites.new( # self._left,
+                int(self._width - 320 * self._scale / 2.5), GRID_CELL_SIZE,
+                self._card_glyph(self.page, 0))
+            self._colored_letters_lower[self.page] = self._level_sprites.new(
+                0, 0, self._card_glyph(self.page, 1))
+            self._colored_letters_upper[self.page] = self._level_sprites.new(
+                0, 0, self._card_glyph(self.page, 2))
+            del self._prepared[self.page]
+            _logger.debug('glyph cache: %d hits, %d from disk, %d rendered' %
+                          self._glyphs.stats()[:3])
 
         self._hide_cards()
         if self.page >= len(self._card_data):
-            self.read()
+            self._read()
         else:
             self._load_card()
         self._looking_at_word_list = False
+        self._start_prefetch()
+
+    def _card_glyph(self, page, i):
+        ''' The card (i = 0) or lower (1) or upper (2) case colored letter
+        of a page, rendered on first use '''
+        if page not in self._prepared:
+            self._prepared[page] = [None, None, None]
+        glyphs = self._prepared[page]
+        if glyphs[i] is None:
+            colors = self._color_data[page][0]
+            if type(colors) != type([]):
+                colors = [colors]
+            stroke = self._test_for_stroke(page)
+            letters = self._card_data[page][0]
+            if i == 0:
+                glyphs[i] = self._colored_glyph(letters.lower(), colors,
+                                                stroke, card=True)
+                return glyphs[i]
+            # Two-tone cards color the first letter only; others color
+            # them all (as in ll or rr).
+            if len(colors) > 1:
+                letters = letters[0]
+            if i == 1:
+                letters = letters.lower()
+            else:
+                letters = letters.upper()
+            glyphs[i] = self._colored_glyph(letters, colors, stroke)
+            self._check_width(glyphs[i], letters)
+        return glyphs[i]
+
+    def _check_width(self, glyph, letters):
+        ''' A colored letter is drawn in place of all of the letters it
+        highlights: make sure it is as wide as they are. '''
+        if len(letters) < 2:
+            return
+        advances = [self._advance(c) for c in letters]
+        # Allow for the side bearing of the last letter.
+        needed = GLYPH_X + sum(advances) - advances[-1] / 2
+        width = _ink_width(glyph)
+        if width < needed:
+            _logger.debug('colored %s is %d pixels wide, not %d' % (
+                    letters, width, needed))
+
+    def _picture_path(self, page):
+        ''' Where the picture for a page is (or None) '''
+        imagefilename = self._image_data[page]
+        if len(imagefilename) > 4:
+            return os.path.join(self._images_path, imagefilename)
+        return None
+
+    def _picture_size(self):
+        ''' Pictures are scaled to fit in this size '''
+        return int(self._scale * 80), int(self._scale * 60)
+
+    def _start_prefetch(self):
+        ''' Prepare the pages either side of this one while we are idle '''
+        self._cancel_prefetch()
+        pages = [page for page in (self.page + 1, self.page - 1)
+                 if page >= 0 and page < len(self._card_data)]
+        keep = pages + [self.page]
+        for page in self._prepared.keys():
+            if page not in keep:
+                del self._prepared[page]
+        self._prefetch_steps = self._prefetch(pages)
+        self._prefetch_id = gobject.idle_add(self._prefetch_cb)
+
+    def _cancel_prefetch(self):
+        ''' Stop preparing pages (e.g., because we are going elsewhere) '''
+        if self._prefetch_id is not None:
+            gobject.source_remove(self._prefetch_id)
+            self._prefetch_id = None
+
+    def _prefetch_cb(self):
+        ''' Do the next few prefetch steps, for no more than a slice '''
+        deadline = time.time() + PREFETCH_SLICE
+        try:
+            while time.time() < deadline:
+                self._prefetch_steps.next()
+        except StopIteration:
+            self._prefetch_id = None
+            return False
+        return True
 
-    def _test_for_stroke(self):
+    def _prefetch(self, pages):
+        ''' Prepare pages a step at a time: their colored glyphs (if we
+        have not made the page yet) and pictures '''
+        for page in pages:
+            if page not in self._cards:
+                for i in range(3):
+                    self._card_glyph(page, i)
+                    yield
+            path = self._picture_path(page)
+            if path is not None:  # Decoded on the image cache's thread
+                self._images.get(path, *self._picture_size())
+            yield
+
+    def _colored_glyph(self, string, colors, stroke, card=False):
+        ''' A letter (or card) in one or two colors. If we can, we tint a
+        single template rather than rendering an SVG for each color. '''
+        if card:
+            args = {'scale': self._scale, 'center': True}
+        else:
+            args = {'font_size': 12 * self._scale, 'background': False}
+
+        if can_colorize():
+            mask = None
+            if stroke:  # White letter, black stroke: tint the white.
+                template = self._glyphs.get(string=string,
+                                            colors=['#FFFFFF', '#FFFFFF'],
+                                            stroke=True, **args)
+                if card:  # but not the white of the card
+                    mask = self._glyphs.get(string=string,
+                                            colors=['#FFFFFF', '#FFFFFF'],
+                                            stroke=True, background=False,
+                                            scale=self._scale, center=True)
+            else:  # Black letters (perhaps several), tinted
+                template = self._glyphs.get(string=string,
+                                            colors=['#000000', '#FFFFFF'],
+                                            **args)
+            return colorize(template, colors, SPLIT, ink=not stroke,
+                            mask=mask)
+
+        top = self._glyphs.get(string=string, colors=[colors[0], '#FFFFFF'],
+                               stroke=stroke, **args)
+        if len(colors) == 1:
+            return top
+        # Two-tone: composite into a copy so the cached glyph is untouched.
+        top = top.copy()
+        bot = self._glyphs.get(string=string, colors=[colors[1], '#FFFFFF'],
+                               stroke=stroke, **args)
+        h = int(SPLIT * top.get_height())
+        bot.composite(top, 0, h, top.get_width(), top.get_height() - h,
+                      0, 0, 1, 1, gtk.gdk.INTERP_NEAREST, 255)
+        return top
+
+    def _test_for_stroke(self, page):
         ''' Light colors get a surrounding stroke '''
         # TODO: better value test
-        if self._color_data[self.page][0][0:4] == '#FFF':
+        if self._color_data[page][0][0:4] == '#FFF':
             return True
         else:
             return False
@@ -282,53 +434,54 @@ class Page():
         self._activity.scrolled_window.set_vadjustment(vadj)
 
         self._cards[self.page].set_layer(2)
-
-        self._x_pos = self._margin
-        self._y_pos = self._cards[self.page].rect.y + \
-                      self._cards[self.page].images[0].get_height() + self._lead
-        rect = gtk.gdk.Rectangle(0, 0, self._width, int(self._height * 2.5))
-        self._my_canvas.images[0].draw_rectangle(self._my_gc, True, *rect)
-        self.invalt(0, 0, self._width, int(self._height * 2.5))
-
-        text = self._card_data[self.page][1]
-        '''
-        for phrase in text.split('\n'):
-            self._x_pos = self._margin * 2
-            self._render_phrase(phrase, self._my_canvas, self._my_gc)
-            # self._x_pos = self._margin
-            self._y_pos += self._lead
-        '''
-        self._x_pos = self._margin * 2
-        self._render_phrase(text, self._my_canvas, self._my_gc)
-        self._x_pos = self._margin * 2
-        self._y_pos += self._lead
-        self._render_phrase(text.upper(), self._my_canvas, self._my_gc)
+        self._chunk = None
+        self._paint_view('card')
 
         # Is there a picture for this page?
-        imagefilename = self._image_data[self.page]
-        if len(imagefilename) > 4 and \
-           os.path.exists(os.path.join(self._images_path, imagefilename)):
-            pixbuf = image_file_to_pixbuf(os.path.join(
-                    self._images_path, imagefilename), self._scale / 4)
-            if self._picture is None:
-                self._picture = Sprite(self._sprites,
-                                  # int(self._width - 320 * self._scale / 2.5),
-                                       self._left,
-                                       GRID_CELL_SIZE, pixbuf)
-            else:
-                self._picture.images[0] = pixbuf
-            self._picture.set_layer(2)
+        path = self._picture_path(self.page)
+        w, h = self._picture_size()
+        if path is not None and os.path.exists(path) and \
+           not self._images.failed(path, w, h):
+            pixbuf = self._images.get(path, w, h, self._picture_cb, self.page)
+            if pixbuf is None:  # Show a placeholder until it is loaded.
+                if self._placeholder is None:
+                    self._placeholder = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB,
+                                                       True, 8, w, h)
+                    self._placeholder.fill(0xEEEEEEFF)
+                pixbuf = self._placeholder
+            self._show_picture(pixbuf)
         elif self._picture is not None:
             self._picture.set_layer(0)
 
         # Hide all the letter sprites.
-        for l in self._letters:
+        for l in self._colored_letters_lower.values():
             l.set_layer(0)
-        for l in self._colored_letters_lower:
+        for l in self._colored_letters_upper.values():
             l.set_layer(0)
-        for l in self._colored_letters_upper:
-            l.set_layer(0)
-        self._my_canvas.set_layer(0)
+
+    def _show_picture(self, pixbuf):
+        ''' Put a picture on the card '''
+        if self._picture is None:
+            self._picture = Sprite(self._sprites,
+                              # int(self._width - 320 * self._scale / 2.5),
+                                   self._left,
+                                   GRID_CELL_SIZE, pixbuf)
+        else:
+            self._picture.set_shape(pixbuf)
+        self._picture.set_layer(2)
+
+    @_render_pass
+    def _picture_cb(self, pixbuf, page):
+        ''' A picture has been loaded: replace the placeholder, if we are
+        still showing the card it belongs to. If it could not be loaded,
+        take the placeholder down. '''
+        if page != self.page or self._picture is None or \
+           self._picture.layer == 0:
+            return
+        if pixbuf is None:
+            self._picture.set_layer(0)
+        else:
+            self._show_picture(pixbuf)
 
     def _strip(self, word, tokens):
         whole = word
@@ -340,47 +493,265 @@ class Page():
         return whole
 
     def reload(self):
+        ''' Switch back and forth between reading and displaying a card. '''
+        self._request(self._reload)
+
+    @_render_pass
+    def _reload(self):
         ''' Switch back and forth between reading and displaying a card. '''
         if self.page < len(self._card_data):
             self._load_card()
         else:
-            self.read()
+            self._read()
         if self._sugar:
             self._activity.status.set_label('')
 
     def read(self):
         ''' Read a word list '''
-        self._clear_all()
-
-        rect = gtk.gdk.Rectangle(0, 0, self._width, int(self._height * 2.75))
-        self._my_canvas.images[0].draw_rectangle(self._my_gc, True, *rect)
-        self.invalt(0, 0, self._width, self._height)
-        self._my_canvas.set_layer(1)
-
-        my_list = self._word_data[self.page].split('/')
-
-        self._x_pos, self._y_pos = self._margin, self._lead
+        self._request(self._read)
+        self._read_aloud()
+
+    def _read_aloud(self):
+        ''' Sound out the highlighted letters of the word list, one after
+        another. The sounds are played once they have all been decoded;
+        we never wait for them on the main loop. '''
+        page, n = self._highlight(self.page)
+        words = []
+        run = 0  # Each word of the list is laid out as a run.
+        for phrase in self._word_data[self.page].split('/'):
+            voiced = []
+            for word in self._compile(phrase, n).words:
+                paths = self._phonemes(word)
+                if len(paths) > 0:
+                    voiced.append((paths, WORD_PAUSE, run))
+                run += 1
+            if len(voiced) > 0:  # The phrase ends after its last sound.
+                voiced[-1] = (voiced[-1][0], PHRASE_PAUSE, voiced[-1][2])
+            words += voiced
+        self._sequence = words
+        self._sequence_sounds = {}
+        self._sequence_tries = 0
+        if len(self._sequence) > 0 and self._sequence_cb():
+            self._sequence_id = gobject.timeout_add(SEQUENCE_POLL,
+                                                    self._sequence_cb)
+
+    def _phonemes(self, word):
+        ''' The sounds of the highlighted letters of a compiled word '''
+        chars = self._glyph_table.chars
+        letters = []
+        for glyph, flag in zip(word.glyphs, word.flags):
+            if flag in (LOWER, UPPER):
+                letters.append(chars[glyph])
+            elif flag == SKIP and len(letters) > 0:
+                letters[-1] += chars[glyph]  # as in ll or rr
+        return [self._letter_sounds[letter.lower()] for letter in letters
+                if letter.lower() in self._letter_sounds]
+
+    def _sequence_cb(self):
+        ''' Play the sounds to read aloud once they have been decoded.
+        Each is held on to as soon as it is ready, so that it cannot be
+        evicted from the cache while we wait for the others. '''
+        sounds = self._sequence_sounds
+        waiting = False
+        for word in self._sequence:
+            for path in word[0]:
+                if path in sounds:
+                    continue
+                if self.sounds.ready([path]):
+                    sounds[path] = self.sounds.get(path)
+                else:
+                    waiting = True
+        self._sequence_tries += 1
+        if waiting and self._sequence_tries < SEQUENCE_TRIES:
+            return True  # Look again later.
+        data, times = sequence([([sounds.get(path) for path in word[0]],
+                                 word[1]) for word in self._sequence])
+        self._timeline = [(start, end, word[2]) for (start, end), word in
+                          zip(times, self._sequence)]
+        play_samples(self, data)
+        _logger.debug('reading aloud %d words, %.1f seconds' % (
+                len(self._timeline), self._timeline[-1][1]))
+        self._sequence = None
+        self._sequence_sounds = {}
+        self._sequence_id = None
+        self._late = []
+        self._read_along_start = time.time()
+        self._highlight_id = gobject.timeout_add(HIGHLIGHT_TICK,
+                                                 self._highlight_cb)
+        return False
 
-        for phrase in my_list:
-            self._render_phrase(phrase, self._my_canvas, self._my_gc)
+    def _highlight_cb(self):
+        ''' Highlight the word being read aloud, by the audio clock '''
+        position = self.aplay.position()
+        if time.time() - self._read_along_start > \
+           self._timeline[-1][1] + READ_ALONG_MARGIN:
+            _logger.debug('read along: gave up waiting for the sound')
+            stop_audio(self)
+            self._end_read_along()
+            return False
+        if position is None:
+            if self.aplay.playing:
+                return True  # It has not started yet.
+            self._end_read_along()
+            return False
+        timeline = self._timeline
+        i = bisect.bisect_right(timeline, (position, )) - 1
+        if i >= 0 and position < timeline[i][1]:
+            run = timeline[i][2]
+        else:  # between words
+            run = None
+        if run != self._spoken:
+            if run is not None:
+                self._late.append(position - timeline[i][0])
+            self._set_spoken(run)
+        return True
 
-            # Put a longer space between each phrase
-            self._x_pos += self._offset
-            if self._x_pos > self._width * 7 / 8.0:
-                self._x_pos, self._y_pos = self._increment_xy(self._y_pos)
+    def _end_read_along(self):
+        ''' The reading is over: take the highlight down '''
+        self._highlight_id = None
+        self._timeline = None
+        self._set_spoken(None)
+        if len(self._late) > 0:
+            _logger.debug('read along: %d words, highlighted %.1f ms late '
+                          '(mean), %.1f ms (worst)' % (
+                    len(self._late),
+                    sum(self._late) * 1000 / len(self._late),
+                    max(self._late) * 1000))
+
+    def _set_spoken(self, run):
+        ''' Move the highlight to a run (or take it down), painting only
+        the words it moves between '''
+        if run == self._spoken:
+            return
+        rects = [self._run_rect(self._runs[i]) for i in (self._spoken, run)
+                 if i is not None and i < len(self._runs)]
+        self._spoken = run
+        self._sprites.begin_damage()
+        for rect in rects:
+            self._tiles.repaint(rect)
+        self._sprites.end_damage(self._viewport())
+
+    def _run_rect(self, run):
+        ''' The part of the canvas a run (and its highlight) covers '''
+        height = max([self._run_pixbuf(glyph, color).get_height()
+                      for dx, glyph, color in run.glyphs] or [self._lead])
+        pad = int(self._offset / 4)
+        return gtk.gdk.Rectangle(int(run.x) - pad, int(run.y),
+                                 int(run.width) + pad * 2, height)
+
+    def _cancel_read_aloud(self):
+        ''' Stop reading aloud (or waiting to) '''
+        if self._sequence_id is not None:
+            gobject.source_remove(self._sequence_id)
+            self._sequence_id = None
+        self._sequence = None
+        self._sequence_sounds = {}
+        if self._highlight_id is not None:
+            gobject.source_remove(self._highlight_id)
+            self._highlight_id = None
+        self._set_spoken(None)
+        if self._timeline is not None:
+            self._timeline = None
+            stop_audio(self)
+
+    @_render_pass
+    def _read(self):
+        ''' Read a word list '''
+        self._clear_all()
+        self._chunk = RENDER_CHUNK
+        self._paint_view('read')
 
         self._looking_at_word_list = False
 
     def test(self):
+        ''' Generate a randomly ordered list of phrases. '''
+        self._request(self._test)
+
+    @_render_pass
+    def _test(self):
         ''' Generate a randomly ordered list of phrases. '''
         self._clear_all()
+        self._chunk = RENDER_CHUNK
+        self._paint_view('test')
 
-        rect = gtk.gdk.Rectangle(0, 0, self._width, int(self._height * 2.75))
-        self._my_canvas.images[0].draw_rectangle(self._my_gc, True, *rect)
-        self.invalt(0, 0, self._width, self._height)
-        self._my_canvas.set_layer(1)
+        self._looking_at_word_list = False
 
-        phrase_list = self._test_data.split('/')
+    def _paint_view(self, mode):
+        ''' Put the text of the current page in a mode on the canvas. Test
+        pages are shuffled each time, so only the others are kept. '''
+        if mode == 'test':
+            key = None
+        else:
+            key = (self._level_loads,) + self._view_key(mode)
+        self._paint(self._get_layout(mode), key)
+
+    def _view_key(self, mode):
+        ''' What the text of the current page in a mode depends on '''
+        if mode == 'list':  # The same for every page
+            return (self._reached, mode, self._width)
+        return (self.page, mode, self._width)
+
+    def _get_layout(self, mode):
+        ''' Runs for the current page in a mode: card, read, test or list '''
+        key = self._view_key(mode)
+        if key not in self._layouts:
+            self._layouts[key] = self._layout_page(mode)
+        if mode == 'test':
+            return self._shuffle(self._layouts[key])
+        return self._layouts[key]
+
+    def _layout_page(self, mode):
+        ''' Position the text of the current page '''
+        layout = self._layout
+        page, n = self._highlight(self.page)
+        runs = []
+
+        if mode == 'card':
+            card = self._cards[self.page]
+            text = self._card_data[self.page][1]
+            x = self._margin * 2
+            y = card.rect.y + card.images[0].get_height() + self._lead
+            runs, x, y = layout.phrase(self._compile(text, n), x, y, page)
+            more, x, y = layout.phrase(self._compile(text.upper(), n),
+                                       self._margin * 2, y + self._lead, page)
+            runs += more
+
+        elif mode == 'read':
+            x, y = self._margin, self._lead
+            for phrase in self._word_data[self.page].split('/'):
+                more, x, y = layout.phrase(self._compile(phrase, n), x, y,
+                                           page)
+                runs += more
+                # Put a longer space between each phrase
+                x += self._offset
+                if x > self._width * 7 / 8.0:
+                    x, y = layout.newline(y)
+
+        elif mode == 'list':
+            y = 0
+            for i, phrase in enumerate(self.get_phrase_list()):
+                page, n = self._highlight(i)
+                more, x, y = layout.phrase(self._compile(phrase, n),
+                                           self._margin, y, page)
+                runs += more
+                y += self._lead
+
+        elif mode == 'test':
+            # Each phrase is laid out at y = 0; _shuffle stacks them up.
+            # Only the first phrase starts at the margin.
+            for phrase in self._test_data.split('/'):
+                phrases = []
+                for x in [self._margin, layout.newline(0)[0]]:
+                    more, x, y = layout.phrase(self._compile(phrase, n), x, 0,
+                                               page)
+                    phrases.append((more, y))
+                runs.append(phrases)
+
+        return runs
+
+    def _shuffle(self, phrases):
+        ''' Generate a randomly ordered list of phrases. '''
+        phrase_list = phrases[:]
         list_length = len(phrase_list)
 
         for i in range(list_length):  # Randomize the phrase order.
@@ -389,34 +760,114 @@ class Page():
             phrase_list[i] = phrase_list[list_length - 1 - j]
             phrase_list[list_length - 1 - j] = tmp
 
-        self._x_pos, self._y_pos = self._margin, self._lead
-
-        for phrase in phrase_list:
-            self._render_phrase(phrase, self._my_canvas, self._my_gc)
-            self._x_pos, self._y_pos = self._increment_xy(self._y_pos)
-            if self._y_pos > self._height * 2 - self._lead:
-                break
-
-        self._looking_at_word_list = False
-
-    def _render_phrase(self, phrase, canvas, gc):
-        ''' Draw an individual phase onto the canvas. '''
-
-        # Either we are rendering complete lines or phrases
-        lines = phrase.split('\\')
-        if len(lines) == 1:  # split a phrase into words
-            words = phrase.split()
-            for word in words:
-                # Will line run off the right edge?
-                if self._x_pos + len(word) * self._offset > \
-                        self._width - self._margin:
-                    self._x_pos, self._y_pos = self._increment_xy(self._y_pos)
-                self._draw_a_word(word, canvas, gc)
-
-        else:  # render each line as a unit
-            for line in lines:
-                self._draw_a_word(line, canvas, gc)
-                self._x_pos, self._y_pos = self._increment_xy(self._y_pos)
+        runs = []
+        y = self._lead
+        for i, phrase in enumerate(phrase_list):
+            more, height = phrase[min(i, 1)]
+            runs += translate(more, y)
+            y = self._layout.newline(y + height)[1]
+        return runs
+
+    def _highlight(self, page):
+        ''' Which colored letters (if any) highlight the text of a page, and
+        how many characters do they cover? The letters of every page up to
+        the furthest we have been are highlighted. '''
+        if page >= len(self._card_data) or page > self._reached:
+            return -1, 1
+        return page, len(self._card_data[page][0])
+
+    def _compile(self, text, n):
+        ''' The token stream for text highlighted n letters at a time '''
+        key = (text, n)
+        if key not in self._compiled:
+            self._compiled[key] = compile_phrase(text, self._glyph_table,
+                                                 self._advance, n)
+        return self._compiled[key]
+
+    def _compile_level(self):
+        ''' Tokenize all of the text in a level up front. '''
+        self._compiled = {}
+        phrases = self.get_phrase_list()
+        if hasattr(self, '_test_data'):
+            tests = self._test_data.split('/')
+        else:
+            tests = []
+        for i, words in enumerate(self._word_data):
+            texts = words.split('/') + tests
+            counts = set([1])
+            if i < len(self._card_data):
+                texts += [self._card_data[i][1], self._card_data[i][1].upper()]
+                counts.add(len(self._card_data[i][0]))
+            if i < len(phrases):
+                texts.append(phrases[i])
+            for n in counts:
+                for text in texts:
+                    self._compile(text, n)
+        self._advances.save()
+
+    def _paint(self, runs, key=None):
+        ''' Put the glyph runs on the canvas. The tiles are painted at the
+        end of the render pass, once we know what can be seen, unless they
+        were kept from the last time the runs with this key were shown. '''
+        self._runs = runs
+        if len(runs) > 0:
+            height = int(max([run.y for run in runs])) + self._lead * 2
+        else:
+            height = 0
+        self._tiles.clear(height, key)
+        self._canvas.set_size_request(self._width, height)
+
+    def _paint_tile(self, pixmap, gc, rect):
+        ''' Draw the glyphs that fall inside rect onto a tile, behind the
+        word being read aloud, its highlight '''
+        for i, run in enumerate(self._runs):
+            y = int(run.y) - rect.y
+            if y >= rect.height:
+                continue
+            if i == self._spoken:
+                self._paint_highlight(pixmap, gc, self._run_rect(run), rect)
+            for dx, glyph, color in run.glyphs:
+                pixbuf = self._run_pixbuf(glyph, color)
+                h = pixbuf.get_height()
+                if y + h <= 0:
+                    continue
+                top = max(0, -y)  # the part above the tile is clipped
+                pixmap.draw_pixbuf(gc, pixbuf, 0, top, int(run.x + dx),
+                                   y + top, -1, h - top)
+
+    def _run_pixbuf(self, glyph, color):
+        ''' The pixbuf drawn for a glyph of a run '''
+        if color == -1:
+            return self._glyph(glyph)
+        page = color >> 1
+        if color & 1:
+            letters = self._colored_letters_upper
+        else:
+            letters = self._colored_letters_lower
+        if page in letters:
+            return letters[page].images[0]
+        # A page we jumped past: its letters have no sprites yet, and
+        # prefetching does not keep them, so we do.
+        key = (page, color & 1)
+        if key in self._list_letters:
+            pixbuf = self._list_letters.pop(key)
+        else:
+            pixbuf = self._card_glyph(page, 1 + (color & 1))
+            if len(self._list_letters) >= LIST_LETTERS:
+                self._list_letters.popitem(last=False)
+        self._list_letters[key] = pixbuf
+        return pixbuf
+
+    def _paint_highlight(self, pixmap, gc, area, rect):
+        ''' Fill area (in canvas coordinates) of a tile at rect with the
+        highlight color '''
+        if self._highlight_color is None:
+            self._highlight_color = gc.get_colormap().alloc_color(HIGHLIGHT)
+        foreground = gc.foreground
+        gc.set_foreground(self._highlight_color)
+        pixmap.draw_rectangle(gc, True, area.x, area.y - rect.y, area.width,
+                              area.height)
+        gc.set_foreground(foreground)
 
     def _letter_match(self, word, char, n):
         ''' Does the current position in the word match the letters on
@@ -431,68 +882,28 @@ class Page():
             return True
         return False
 
-    def _draw_a_word(self, word, canvas, gc):
-        ''' Process each character in the word '''
-
-        # some colored text is multiple characters
-        if self.page != -1 and self.page < len(self._card_data):
-            n = len(self._card_data[self.page][0])
-        else:
-            n = 1
-
-        skip_count = 0
-        # Draw letters enclosed in () in color
-        draw_in_color = False
-        for char in range(len(word)):
-            if skip_count > 0:
-                skip_count -= 1
-            elif word[char] == '(' and not draw_in_color:
-                draw_in_color = True
-            elif word[char] == ')' and draw_in_color:
-                draw_in_color = False
-            elif draw_in_color and self.page != -1:
-                if word[char].islower():
-                    self._draw_pixbuf(
-                        self._colored_letters_lower[self.page].images[0],
-                        self._x_pos, self._y_pos, canvas, gc)
-                    kern_char = word[char].lower()
-                else:
-                    self._draw_pixbuf(
-                        self._colored_letters_upper[self.page].images[0],
-                        self._x_pos, self._y_pos, canvas, gc)
-                    kern_char = word[char].upper()
-                if n > 1:
-                    skip_count = n - 1
-            else:
-                if word[char] in ALPHABET:
-                    i = ALPHABET.index(word[char])
-                    self._draw_pixbuf(self._letters[i].images[0],
-                                      self._x_pos, self._y_pos,
-                                      canvas, gc)
-                    kern_char = word[char]
-
-            if word[char] not in '()':
-                if kern_char in KERN:
-                    self._x_pos += self._offset * KERN[kern_char]
-                else:
-                    self._x_pos += self._offset
-
-        self._final_x = self._x_pos
-        # Put a space after each word
-        if self._x_pos > self._margin:
-            self._x_pos += int(self._offset / 1.6)
-
-    def _draw_pixbuf(self, pixbuf, x, y, canvas, gc):
-        ''' Draw a pixbuf onto the canvas '''
-        w = pixbuf.get_width()
-        h = pixbuf.get_height()
-        canvas.images[0].draw_pixbuf(gc, pixbuf, 0, 0, int(x), int(y))
-        self.invalt(x, y, w, h)
-
-    def _increment_xy(self, y):
-        ''' Increment the xy postion for drawing the next phrase, with
-        left-justified alignment. '''
-        return 10, self._lead + y
+    def _advance(self, char):
+        ''' How far to move after drawing a glyph '''
+        return self._advances.get(char)
+
+    def _measure(self, char):
+        ''' Measure the advance of a glyph as pango (and so rsvg) draws it '''
+        fd = pango.FontDescription(FONT)
+        fd.set_absolute_size(int(12 * self._scale) * pango.SCALE)
+        pl = self._canvas.create_pango_layout(char)
+        pl.set_font_description(fd)
+        return pl.get_size()[0] / float(pango.SCALE)
+
+    def _glyph(self, i):
+        ''' Return glyph i, rasterizing it on first use '''
+        while len(self._letters) <= i:
+            self._letters.append(None)
+        if self._letters[i] is None:
+            self._letters[i] = self._glyphs.get(
+                string=self._glyph_table.chars[i],
+                colors=['#000000', '#000000'],
+                font_size=12 * self._scale, background=False)
+        return self._letters[i]
 
     def _button_press_cb(self, win, event):
         ''' Either a card or list entry was pressed. '''
@@ -513,28 +924,26 @@ class Page():
 
         if self._looking_at_word_list:
             self._looking_at_word_list = False
-            if self._goto_page > self.page:
-                for _i in range(self._goto_page - self.page):
-                    self.page += 1
-                    self.new_page()
-            else:
-                self.page = self._goto_page
-                self.new_page()
+            self.page = min(self._goto_page, len(self._word_data) - 1)
+            self.new_page()
         else:
             x, y = map(int, event.get_coords())
             spr = self._sprites.find_sprite((x, y))
+            if spr == self._picture or (
+                spr is not None and spr == self._cards.get(self.page)):
+                self._cancel_read_aloud()
             if spr == self._picture:
                 if self.page < len(self._card_data):
                     if len(self._media_data[self.page][0]) > 4 and \
-                       os.path.exists(os.path.join(
+                       self.sounds.exists(os.path.join(
                             self._sounds_path,
                             self._media_data[self.page][0])):
                         play_audio_from_file(self, os.path.join(
                                 self._sounds_path,
                                 self._media_data[self.page][0]))
-            elif spr == self._cards[self.page]:
+            elif spr is not None and spr == self._cards.get(self.page):
                 if self.page < len(self._card_data):
-                    if os.path.exists(os.path.join(
+                    if self.sounds.exists(os.path.join(
                             self._sounds_path,
                             self._media_data[self.page][1])):
                         play_audio_from_file(self, os.path.join(
@@ -559,8 +968,9 @@ class Page():
         return True
 
     def _expose_cb(self, win, event):
-        ''' When asked, we need to refresh the screen. '''
-        self._sprites.redraw_sprites()
+        ''' When asked, we need to refresh the screen (or what of it has
+        been exposed). '''
+        self._sprites.refresh(event)
         return True
 
     def _destroy_cb(self, win, event):
@@ -569,8 +979,91 @@ class Page():
 
     def invalt(self, x, y, w, h):
         ''' Mark a region for refresh '''
-        self._canvas.window.invalidate_rect(
-            gtk.gdk.Rectangle(int(x), int(y), int(w), int(h)), False)
+        self._sprites.inval(
+            gtk.gdk.Rectangle(int(x), int(y), int(w), int(h)))
+
+    def _begin_render(self):
+        ''' Start collecting the damage done by a render pass. '''
+        if self._render_depth == 0:
+            self._damage_counts = (self._sprites.damage_rects,
+                                   self._sprites.invalidations)
+        self._render_depth += 1
+        self._sprites.begin_damage()
+
+    def _end_render(self):
+        ''' Paint the tiles that can be seen and invalidate what was
+        damaged, as far as it can be seen. '''
+        self._render_depth -= 1
+        viewport = self._viewport()
+        if self._render_depth == 0 and \
+           self._tiles.show(viewport, self._chunk):
+            # Paint the rest on the next passes of the main loop.
+            self._more_tiles = True
+            self._schedule()
+        self._sprites.end_damage(viewport)
+        if self._render_depth == 0:
+            _logger.debug('render: %d rects, %d invalidations, %d tiles' % (
+                    self._sprites.damage_rects - self._damage_counts[0],
+                    self._sprites.invalidations - self._damage_counts[1],
+                    self._tiles.stats()[0]))
+            _logger.debug('surfaces: %d hits, %d misses, %d evicted, '
+                          '%d bytes' % self._tiles.cache_stats())
+
+    @_render_pass
+    def _scroll_cb(self, vadj):
+        ''' Paint the tiles scrolled into view (at the end of the pass) '''
+
+    @_render_pass
+    def _show_tiles(self):
+        ''' Paint the next chunk of tiles (at the end of the pass) '''
+        self._more_tiles = False
+
+    def _request(self, render):
+        ''' Ask for a render on the next pass of the main loop. Only the
+        last render asked for by then is done, and it replaces any render
+        still being painted a chunk at a time. '''
+        if self._pending is not None:
+            self.coalesced += 1
+        elif self._more_tiles:
+            self.cancelled += 1
+        self._cancel_read_aloud()  # The text is going away.
+        self._more_tiles = False
+        self._pending = render
+        self._schedule()
+
+    def _schedule(self):
+        ''' Run the render callback before the next redraw '''
+        if self._render_id is None:
+            self._render_id = gobject.idle_add(
+                self._render_cb, priority=gobject.PRIORITY_HIGH_IDLE)
+
+    def _render_cb(self):
+        ''' Do the render asked for, or the next chunk of the last one '''
+        # Forget this callback first, so that a render that fails does not
+        # stop the ones after it from being scheduled.
+        self._render_id = None
+        if self._pending is not None:
+            render = self._pending
+            self._pending = None
+            self.renders += 1
+            render()
+            _logger.debug('renders: %d done, %d coalesced, %d cancelled' % (
+                    self.renders, self.coalesced, self.cancelled))
+        elif self._more_tiles:
+            self._show_tiles()
+        if self._pending is not None or self._more_tiles:
+            self._schedule()
+        return False
+
+    def _viewport(self):
+        ''' The visible part of the canvas '''
+        if not hasattr(self._activity, 'scrolled_window'):
+            return None
+        vadj = self._activity.scrolled_window.get_vadjustment()
+        if vadj.get_page_size() <= 0:  # Not laid out yet
+            return None
+        return gtk.gdk.Rectangle(0, int(vadj.get_value()), self._width,
+                                 int(vadj.get_page_size()) + 1)
 
     def load_level(self, path):
         ''' Load a level (CSV) from path: letter, word, color, image,
@@ -579,7 +1072,21 @@ class Page():
         self._color_data = []
         self._image_data = []
         self._media_data = []  # (image sound, letter sound)
+        self._letter_sounds = {}  # letter: path of its sound
         self._word_data = []
+        self._layouts = {}
+        # Painted pages are kept by this, not by path: the level file may
+        # have changed since it was last loaded.
+        self._level_loads += 1
+        self._cancel_prefetch()
+        self._cancel_read_aloud()
+        stop_audio(self)
+        self._paint([])  # The old runs use the old level's letters.
+        self._tiles.forget()  # Their keys will not come up again.
+        self._more_tiles = False
+        self._prepared = {}
+        self._list_letters = OrderedDict()
+        self._reached = -1
         f = codecs.open(path, encoding='utf-8')
         for line in f:
             if len(line) > 0 and line[0] not in '#\n':
@@ -595,6 +1102,9 @@ class Page():
                             [words[2]])
                     self._image_data.append(words[3])
                     self._media_data.append((words[4], words[5]))
+                    if len(words[5]) > 4:
+                        self._letter_sounds[words[0].lower()] = \
+                            os.path.join(self._sounds_path, words[5])
                 if words[0] == '+':
                     self._test_data = words[6]
                 else:
@@ -602,9 +1112,20 @@ class Page():
         f.close()
 
         self._clear_all()
-        self._cards = []
-        self._colored_letters_lower = []
-        self._colored_letters_upper = []
+        # The sprites of the old level go back to the pool.
+        self._level_sprites.release()
+        self._cards = {}
+        self._colored_letters_lower = {}
+        self._colored_letters_upper = {}
+        _logger.debug('sprites: %d live, %d bytes of pixbufs' %
+                      self._sprites.stats())
+        self._compile_level()
+        _logger.debug('sounds: %d hits, %d from the bank, %d misses, %d '
+                      'evicted, %d kept in %d bytes' % self.sounds.stats())
+        # Decoded on the sound cache's thread
+        self.sounds.preload([os.path.join(self._sounds_path, sound)
+                             for sounds in self._media_data
+                             for sound in sounds if len(sound) > 4])
 
     def _clear_all(self):
         ''' Hide everything so we can begin a new page. '''
@@ -614,9 +1135,28 @@ class Page():
 
     def _hide_cards(self):
         ''' Hide any cards that might be around. '''
-        for card in self._cards:
+        for card in self._cards.values():
             card.set_layer(0)
 
+
+def _ink_width(pixbuf):
+    ''' How far from the left edge of a pixbuf anything is drawn '''
+    if not pixbuf.get_has_alpha():
+        return pixbuf.get_width()
+    pixels = pixbuf.get_pixels()
+    rowstride = pixbuf.get_rowstride()
+    for x in range(pixbuf.get_width() - 1, -1, -1):
+        for y in range(pixbuf.get_height()):
+            if pixels[y * rowstride + x * 4 + 3] != '\x00':
+                return x + 1
+    return 0
+
+
+def card_to_pixbuf(**kwargs):
+    ''' Rasterize a genpieces card. '''
+    return svg_str_to_pixbuf(generate_card(**kwargs))
+
+
 def svg_str_to_pixbuf(svg_string):
     ''' Load pixbuf from SVG string. '''
     pl = gtk.gdk.PixbufLoader('svg')
@@ -624,13 +1164,3 @@ def svg_str_to_pixbuf(svg_string):
     pl.close()
     pixbuf = pl.get_pixbuf()
     return pixbuf
-
-
-def image_file_to_pixbuf(file_path, scale):
-    ''' Load pixbuf from file '''
-    try:
-        return gtk.gdk.pixbuf_new_from_file_at_size(
-            file_path, int(scale * 320), int(scale * 240))
-    except:
-        _logger.debug('failed to load %s', file_path)
-        return None
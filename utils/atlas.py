@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+#Copyright (c) 2011 Walter Bender
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""
+atlas.py stores the pictures of a lesson pack, already scaled for the
+screen, as raw RGBA in a single file that is memory-mapped when it is
+used. Turning an entry into a pixbuf is a copy, not a PNG decode.
+
+The file is a magic line, the pixels of each picture (rows of width * 4
+bytes) one after another, then a JSON index of
+
+    name: [offset, width, height, source mtime, source size]
+
+(width and height are 0 for a picture that could not be loaded) and
+finally the offset of the index as 8 ASCII hex digits. An atlas is
+made for one size; if a source picture is added or changes, the whole
+atlas is made again.
+
+Example usage:
+        atlas = Atlas('images/es', width, height, cache_path)
+        atlas.load()  # slow if the atlas must be (re)made
+        pixbuf = atlas.pixbuf('images/es/gato.png', mtime)
+"""
+
+import gtk
+import gobject
+import os
+import re
+import json
+import mmap
+
+import logging
+_logger = logging.getLogger('infused-activity')
+
+MAGIC = 'ICanRead atlas 1\n'
+
+
+class Atlas:
+    """ Pre-scaled pictures of a directory, memory-mapped """
+
+    def __init__(self, directory, width, height, path):
+        """ Pictures in directory are scaled to fit width x height; the
+        atlas is kept in path. """
+        self._directory = os.path.normpath(directory)
+        self.width = width
+        self.height = height
+        self._path = path
+        self._prefix = 'pictures-%s-' % (os.path.basename(self._directory))
+        self._filename = os.path.join(path, '%s%dx%d.atlas' % (
+                self._prefix, width, height))
+        self._index = {}
+        self._map = None
+
+    def load(self):
+        """ Map the atlas, making it first if it is missing or stale.
+        Returns True if the atlas can be used. """
+        sources = self._sources()
+        if not self._open(sources):
+            self._build(sources)
+            if not self._open(sources):
+                return False
+        return True
+
+    def pixbuf(self, path, mtime):
+        """ The picture at path, or None if it is not in the atlas (or has
+        changed since the atlas was made) """
+        if self._map is None or \
+           os.path.dirname(os.path.normpath(path)) != self._directory:
+            return None
+        entry = self._index.get(os.path.basename(path))
+        if entry is None or entry[3] != mtime or entry[1] == 0:
+            return None
+        offset, width, height = entry[0:3]
+        return gtk.gdk.pixbuf_new_from_data(
+            self._map[offset:offset + width * height * 4],
+            gtk.gdk.COLORSPACE_RGB, True, 8, width, height, width * 4)
+
+    def _sources(self):
+        """ name: (mtime, size) of the pictures in the directory """
+        sources = {}
+        try:
+            names = os.listdir(self._directory)
+        except OSError:
+            return sources
+        for name in names:
+            if name.lower().endswith('.png'):
+                st = os.stat(os.path.join(self._directory, name))
+                sources[name] = (st.st_mtime, st.st_size)
+        return sources
+
+    def _open(self, sources):
+        """ Map the atlas if it is up to date with sources """
+        if not os.path.exists(self._filename):
+            return False
+        data = None
+        try:
+            f = open(self._filename, 'rb')
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                f.close()
+            if data[0:len(MAGIC)] != MAGIC:
+                raise ValueError('not an atlas')
+            start = int(data[-8:], 16)
+            index = json.loads(data[start:-8])
+        except (EnvironmentError, ValueError):
+            _logger.debug('ignoring bad atlas %s', self._filename)
+            if data is not None:
+                data.close()
+            return False
+        for name, (mtime, size) in sources.iteritems():
+            if name not in index or index[name][3:5] != [mtime, size]:
+                data.close()
+                return False
+        self._map = data
+        self._index = index
+        return True
+
+    def _build(self, sources):
+        """ Scale every picture and write them out """
+        index = {}
+        try:
+            f = open(self._filename + '.tmp', 'wb')
+            f.write(MAGIC)
+            for name, (mtime, size) in sources.iteritems():
+                try:
+                    pixbuf = gtk.gdk.pixbuf_new_from_file_at_size(
+                        os.path.join(self._directory, name), self.width,
+                        self.height)
+                except gobject.GError:
+                    _logger.debug('failed to load %s', name)
+                    index[name] = [0, 0, 0, mtime, size]
+                    continue
+                if not pixbuf.get_has_alpha():
+                    pixbuf = pixbuf.add_alpha(False, 0, 0, 0)
+                w = pixbuf.get_width()
+                h = pixbuf.get_height()
+                rowstride = pixbuf.get_rowstride()
+                pixels = pixbuf.get_pixels()
+                index[name] = [f.tell(), w, h, mtime, size]
+                for y in range(h):
+                    f.write(pixels[y * rowstride:y * rowstride + w * 4])
+            start = f.tell()
+            json.dump(index, f)
+            f.write('%08x' % (start))
+            f.close()
+            os.rename(self._filename + '.tmp', self._filename)
+            _logger.debug('made atlas %s of %d pictures', self._filename,
+                          len(index))
+        except (IOError, OSError):
+            _logger.debug('failed to make atlas %s', self._filename)
+            return
+        self._remove_others()
+
+    def _remove_others(self):
+        """ Delete the atlases of this directory made for other sizes """
+        size = re.compile(r'\d+x\d+\.atlas$')
+        try:
+            names = os.listdir(self._path)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self._path, name)
+            if name.startswith(self._prefix) and path != self._filename and \
+               size.match(name[len(self._prefix):]):
+                try:
+                    os.remove(path)
+                    _logger.debug('removed old atlas %s', path)
+                except OSError:
+                    pass
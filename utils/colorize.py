@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+#Copyright (c) 2011 Walter Bender
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""
+colorize.py tints a glyph rasterized once into any one- or two-tone
+color, so that colored letters and cards do not need their own SVG.
+
+There are two kinds of template:
+
+  ink:  the glyph is drawn in black (on white or transparent); black
+        becomes the new color and white stays white.
+  fill: the glyph is drawn in white with a black stroke; white becomes
+        the new color and the black stroke is kept.
+
+The alpha channel of the template is preserved. Two-tone glyphs switch
+from the first to the second color at split * height.
+
+A fill template drawn on a white card would have its card tinted too, so
+it can be given a mask: the same glyph drawn without the card. Only the
+pixels the mask covers (by its alpha) are tinted.
+
+numpy is required; check can_colorize() before calling colorize().
+"""
+
+import gtk
+
+try:
+    import numpy
+    _HAVE_NUMPY = True
+except ImportError:
+    _HAVE_NUMPY = False
+
+
+def can_colorize():
+    """ Is the colorization engine available? """
+    return _HAVE_NUMPY
+
+
+def colorize(template, colors, split=None, ink=True, mask=None):
+    """ Return a new pixbuf: template tinted in colors (only where the
+    mask, if there is one, is opaque) """
+    if not template.get_has_alpha():
+        template = template.add_alpha(False, 0, 0, 0)
+    pixels = pixbuf_to_array(template)
+    h = pixels.shape[0]
+    rgb = pixels[:, :, 0:3].astype(numpy.uint16)
+    out = numpy.empty(pixels.shape, dtype=numpy.uint8)
+    out[:, :, 3] = pixels[:, :, 3]
+
+    if len(colors) > 1 and split is not None:
+        bands = [(0, int(split * h), colors[0]),
+                 (int(split * h), h, colors[1])]
+    else:
+        bands = [(0, h, colors[0])]
+    for top, bottom, color in bands:
+        c = numpy.array(_rgb(color), dtype=numpy.uint16)
+        if ink:
+            out[top:bottom, :, 0:3] = 255 - \
+                (255 - rgb[top:bottom]) * (255 - c) // 255
+        else:
+            out[top:bottom, :, 0:3] = rgb[top:bottom] * c // 255
+    if mask is not None:
+        if not mask.get_has_alpha():
+            mask = mask.add_alpha(False, 0, 0, 0)
+        alpha = pixbuf_to_array(mask)[:, :, 3:4].astype(numpy.uint16)
+        out[:, :, 0:3] = (out[:, :, 0:3] * alpha +
+                          rgb * (255 - alpha)) // 255
+    return array_to_pixbuf(out)
+
+
+def pixbuf_to_array(pixbuf):
+    """ A (height, width, channels) view of the pixbuf's pixels """
+    w = pixbuf.get_width()
+    h = pixbuf.get_height()
+    n = pixbuf.get_n_channels()
+    rowstride = pixbuf.get_rowstride()
+    data = numpy.frombuffer(pixbuf.get_pixels(), dtype=numpy.uint8)
+    if len(data) < rowstride * h:  # the last row need not be padded
+        data = numpy.concatenate((data, numpy.zeros(rowstride * h - len(data),
+                                                    dtype=numpy.uint8)))
+    return data[0:rowstride * h].reshape(h, rowstride)[:, 0:w * n].reshape(
+        h, w, n)
+
+
+def array_to_pixbuf(pixels):
+    """ Create an RGBA pixbuf from a (height, width, 4) array """
+    h, w = pixels.shape[0:2]
+    return gtk.gdk.pixbuf_new_from_data(
+        numpy.ascontiguousarray(pixels).tostring(), gtk.gdk.COLORSPACE_RGB,
+        True, 8, w, h, w * 4)
+
+
+def _rgb(color):
+    """ '#RRGGBB' -> (r, g, b) """
+    return (int(color[1:3], 16), int(color[3:5], 16), int(color[5:7], 16))
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+#Copyright (c) 2011 Walter Bender
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""
+glyph_cache.py keeps the pixbufs rasterized from genpieces SVG cards so
+that we only pay for rsvg once per glyph.
+
+Rasterized glyphs are held in memory with least-recently-used eviction
+and, if a path is given, written to disk as PNG files so that the next
+launch can skip SVG parsing entirely.
+
+Example usage:
+        cache = GlyphCache(render, path)
+        pixbuf = cache.get(string='a', colors=['#000000', '#000000'],
+                           font_size=36, background=False)
+
+where render(**kwargs) returns a pixbuf for the generate_card arguments.
+"""
+
+import gtk
+import gobject
+import os
+import hashlib
+
+from collections import OrderedDict
+
+import logging
+_logger = logging.getLogger('infused-activity')
+
+
+class GlyphCache:
+    """ A memory (LRU) and disk cache of rasterized glyphs """
+
+    def __init__(self, render, path=None, size=256):
+        """ render is called with the generate_card arguments on a miss """
+        self._render = render
+        self._path = path
+        self._size = size
+        self._pixbufs = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if self._path is not None and not os.path.exists(self._path):
+            try:
+                os.makedirs(self._path)
+            except OSError:
+                _logger.debug('cannot create glyph cache %s', self._path)
+                self._path = None
+
+    def get(self, string='a', colors=['#FF0000', '#FFFFFF'],
+            background=True, scale=1, stroke=False, center=False,
+            font_size=40):
+        """ Return the pixbuf for a card, rendering it only if needed """
+        if isinstance(string, str):
+            string = string.decode('utf-8')
+        key = (string, tuple(colors), float(font_size), float(scale),
+               bool(stroke), bool(background), bool(center))
+
+        if key in self._pixbufs:
+            self.hits += 1
+            pixbuf = self._pixbufs.pop(key)
+            self._pixbufs[key] = pixbuf
+            return pixbuf
+
+        pixbuf = self._load(key)
+        if pixbuf is not None:
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+            pixbuf = self._render(string=string, colors=list(colors),
+                                  background=background, scale=scale,
+                                  stroke=stroke, center=center,
+                                  font_size=font_size)
+            self._save(key, pixbuf)
+
+        self._pixbufs[key] = pixbuf
+        while len(self._pixbufs) > self._size:
+            self._pixbufs.popitem(last=False)
+        return pixbuf
+
+    def stats(self):
+        """ Return (memory hits, disk hits, misses, entries) """
+        return (self.hits, self.disk_hits, self.misses, len(self._pixbufs))
+
+    def _filename(self, key):
+        """ Disk location for a glyph """
+        return os.path.join(self._path, '%s.png' % (
+                hashlib.md5(repr(key)).hexdigest()))
+
+    def _load(self, key):
+        """ Read a previously rasterized glyph from disk """
+        if self._path is None:
+            return None
+        filename = self._filename(key)
+        if not os.path.exists(filename):
+            return None
+        try:
+            return gtk.gdk.pixbuf_new_from_file(filename)
+        except gobject.GError:
+            _logger.debug('discarding damaged glyph %s', filename)
+            os.remove(filename)
+            return None
+
+    def _save(self, key, pixbuf):
+        """ Write a rasterized glyph to disk """
+        if self._path is None or pixbuf is None:
+            return
+        filename = self._filename(key)
+        try:
+            pixbuf.save(filename + '.tmp', 'png')
+            os.rename(filename + '.tmp', filename)
+        except (gobject.GError, OSError):
+            _logger.debug('failed to save glyph %s', filename)
+
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+#Copyright (c) 2011 Walter Bender
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""
+image_cache.py keeps the lesson pictures, decoded and scaled, so that
+going back to a page does not mean reading its PNG again.
+
+Pictures that are not in the (LRU) cache are decoded on a worker thread,
+so a slow disk never holds up the main loop. Entries are keyed by path,
+modification time and size, so an edited picture is read again.
+
+If an Atlas (see atlas.py) of the pictures is given, it is loaded (and if
+need be made) on the worker thread; once it is ready, pictures of its size
+are copied out of it rather than decoded.
+
+Example usage:
+        cache = ImageCache()
+        pixbuf = cache.get(path, width, height, callback, data)
+
+where get returns the pixbuf if it is cached; if not, it returns None and
+callback(pixbuf, data) is called from the main loop once the picture has
+been decoded (pixbuf is None if it could not be). A picture that could not
+be decoded is not tried again unless it changes; see failed().
+"""
+
+import gtk
+import gobject
+import os
+import threading
+import Queue
+
+from collections import OrderedDict
+
+import logging
+_logger = logging.getLogger('infused-activity')
+
+gobject.threads_init()
+
+
+class ImageCache:
+    """ A memory (LRU) cache of scaled pictures, loaded in the background """
+
+    def __init__(self, size=8, atlas=None):
+        self._size = size
+        self._pixbufs = OrderedDict()
+        self._loading = {}  # key: [(callback, args), ...]
+        self._failed = set()  # keys of pictures that could not be decoded
+        self._queue = Queue.Queue()
+        self._thread = None
+        self._atlas = atlas
+        self._atlas_ready = False
+        self.hits = 0
+        self.atlas_hits = 0
+        self.misses = 0
+        if self._atlas is not None:
+            self._start(None)  # Load the atlas first.
+
+    def get(self, path, width, height, callback=None, *args):
+        """ Return the picture at path scaled to fit width x height, if we
+        have it. Otherwise start loading it and return None. """
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None
+        key = (path, mtime, width, height)
+        if key in self._failed:
+            return None
+
+        if key in self._pixbufs:
+            self.hits += 1
+            pixbuf = self._pixbufs.pop(key)
+            self._pixbufs[key] = pixbuf
+            return pixbuf
+
+        if self._atlas_ready and (width, height) == (self._atlas.width,
+                                                     self._atlas.height):
+            pixbuf = self._atlas.pixbuf(path, mtime)
+            if pixbuf is not None:
+                self.atlas_hits += 1
+                self._keep(key, pixbuf)
+                return pixbuf
+
+        if key not in self._loading:
+            self.misses += 1
+            self._loading[key] = []
+            self._start(key)
+        if callback is not None:
+            self._loading[key].append((callback, args))
+        return None
+
+    def failed(self, path, width, height):
+        """ Did the picture at path fail to decode at this size? """
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return True
+        return (path, mtime, width, height) in self._failed
+
+    def stats(self):
+        """ Return (hits, atlas hits, misses, entries) """
+        return (self.hits, self.atlas_hits, self.misses, len(self._pixbufs))
+
+    def _start(self, key):
+        """ Queue a job for the worker thread (None loads the atlas) """
+        self._queue.put(key)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._worker)
+            self._thread.setDaemon(True)
+            self._thread.start()
+
+    def _keep(self, key, pixbuf):
+        """ Cache a picture, forgetting the least recently used """
+        self._pixbufs[key] = pixbuf
+        while len(self._pixbufs) > self._size:
+            self._pixbufs.popitem(last=False)
+
+    def _worker(self):
+        """ Decode pictures as they are asked for """
+        while True:
+            key = self._queue.get()
+            if key is None:
+                if self._atlas.load():
+                    gobject.idle_add(self._use_atlas)
+                continue
+            path, mtime, width, height = key
+            try:
+                pixbuf = gtk.gdk.pixbuf_new_from_file_at_size(path, width,
+                                                              height)
+            except gobject.GError:
+                _logger.debug('failed to load %s', path)
+                pixbuf = None
+            gobject.idle_add(self._deliver, key, pixbuf)
+
+    def _use_atlas(self):
+        """ The atlas has been loaded """
+        self._atlas_ready = True
+        return False
+
+    def _deliver(self, key, pixbuf):
+        """ Cache a decoded picture and tell whoever was waiting for it """
+        if pixbuf is not None:
+            self._keep(key, pixbuf)
+        else:
+            self._failed.add(key)
+        for callback, args in self._loading.pop(key, []):
+            callback(pixbuf, *args)
+        return False
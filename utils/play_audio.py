@@ -23,12 +23,150 @@
 # USA
 
 
-import subprocess
+import logging
+import os
+import time
+import urllib
+
+import gobject
+gobject.threads_init()
+
+import pygst
+import gst
+
+from utils.sound_cache import CAPS, BYTES_PER_SECOND
+
 
 def play_audio_from_file(parent, file_path):
-    """ Audio media """
-    command_line = ['gst-launch', 'filesrc', 'location=' + file_path,
-                    '! oggdemux', '! vorbisdec', '! audioconvert',
-                    '! alsasink']
-    subprocess.call(command_line)
+    """ Audio media: play a sound without waiting for it to finish. A
+    sound that is still playing is cut off. If parent.sounds has the
+    sound decoded, it is played from memory. """
+    if parent.aplay is None:
+        parent.aplay = Aplay()
+    data = parent.sounds.get(file_path)
+    if data is not None:
+        parent.aplay.play_pcm(data)
+    elif os.path.exists(file_path):
+        parent.aplay.play(file_path)
+    else:  # Only in a sound bank: it will play once it is decoded.
+        logging.debug('not yet decoded: %s' % (file_path))
+
+
+def play_samples(parent, data):
+    """ Play samples in the format of sound_cache.CAPS, such as a sequence
+    of sounds, without waiting for them to finish """
+    if parent.aplay is None:
+        parent.aplay = Aplay()
+    parent.aplay.play_pcm(data)
+
+
+def stop_audio(parent):
+    """ Stop any sound that is playing """
+    if parent.aplay is not None:
+        parent.aplay.stop()
+
+
+class Aplay():
+    """ A player that is built once and reused for every sound """
+
+    def __init__(self):
+        self.player = gst.element_factory_make('playbin', 'aplayer')
+        self.player.set_property('video-sink',
+                                 gst.element_factory_make('fakesink'))
+        self._watch(self.player)
+        self.pcm_player = gst.parse_launch(
+            'appsrc name=src ! audioconvert ! audioresample ! alsasink')
+        self._src = self.pcm_player.get_by_name('src')
+        self._src.set_property('caps', gst.caps_from_string(CAPS))
+        self._src.set_property('format', gst.FORMAT_TIME)
+        self._watch(self.pcm_player)
+        self._pipeline = self.player  # the one playing, or last played
+        self.playing = False
+        self.from_memory = False
+        self._tap = None  # when we were asked to play
+        self.plays = 0
+        self.replaced = 0  # sounds cut off by another
+        self.latency = 0.  # seconds from play to playing, last sound
+        self._total_latency = 0.
+
+    def play(self, file_path):
+        """ Start playing a file (in the background) """
+        self._start(self.player, False)
+        self.player.set_property('uri', 'file://' + urllib.quote(
+                os.path.abspath(file_path)))
+        self.player.set_state(gst.STATE_PLAYING)
+
+    def play_pcm(self, data):
+        """ Start playing samples in CAPS format (in the background) """
+        self._start(self.pcm_player, True)
+        self.pcm_player.set_state(gst.STATE_PLAYING)
+        buffer = gst.Buffer(data)
+        buffer.timestamp = 0
+        buffer.duration = len(data) * gst.SECOND / BYTES_PER_SECOND
+        self._src.emit('push-buffer', buffer)
+        self._src.emit('end-of-stream')
+
+    def position(self):
+        """ How far (in seconds, by the audio clock) we are into the sound
+        being played, or None if it is not playing (yet) """
+        if not self.playing:
+            return None
+        try:
+            position, format = self._pipeline.query_position(
+                gst.FORMAT_TIME, None)
+        except gst.QueryError:
+            return None
+        return float(position) / gst.SECOND
+
+    def stop(self):
+        """ Cut off the sound being played """
+        self._pipeline.set_state(gst.STATE_NULL)
+        self.playing = False
+
+    def _start(self, pipeline, from_memory):
+        """ Cut off the sound being played and get ready for another """
+        if self.playing:
+            self.replaced += 1
+        self.stop()
+        self._pipeline = pipeline
+        self.from_memory = from_memory
+        self._tap = time.time()
+        self.plays += 1
+        self.playing = True
+
+    def _watch(self, pipeline):
+        bus = pipeline.get_bus()
+        bus.add_signal_watch()
+        bus.connect('message', self._on_message, pipeline)
+
+    def stats(self):
+        """ Return (sounds played, sounds cut off, last latency, mean
+        latency), latencies in milliseconds """
+        if self.plays == 0:
+            return (0, 0, 0., 0.)
+        return (self.plays, self.replaced, self.latency * 1000,
+                self._total_latency * 1000 / self.plays)
 
+    def _on_message(self, bus, message, pipeline):
+        if pipeline != self._pipeline:
+            return  # from a sound that has been cut off
+        t = message.type
+        if t == gst.MESSAGE_EOS:
+            self.stop()
+        elif t == gst.MESSAGE_ERROR:
+            err, debug = message.parse_error()
+            logging.debug('Error: %s - %s' % (err, debug))
+            self.stop()
+        elif t == gst.MESSAGE_STATE_CHANGED and \
+             message.src == pipeline and self._tap is not None:
+            old, new, pending = message.parse_state_changed()
+            if new == gst.STATE_PLAYING:
+                self.latency = time.time() - self._tap
+                self._total_latency += self.latency
+                self._tap = None
+                logging.debug('sound: %.1f ms to play from %s (%d played, '
+                              '%d cut off, %.1f ms mean)' % (
+                        self.latency * 1000,
+                        ['file', 'memory'][int(self.from_memory)],
+                        self.plays, self.replaced,
+                        self._total_latency * 1000 / self.plays))
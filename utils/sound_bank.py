@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#Copyright (c) 2011 Walter Bender
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""
+sound_bank.py packs the sounds of a language (sounds/es/*.ogg) into a
+single file (sounds/es.bank) that is memory-mapped when it is used, so
+that playing a sound does not mean opening (or even finding) its file.
+
+The file is a magic line, the sounds one after another, then a JSON
+index of
+
+    name: [offset, length, format, source mtime, source size]
+
+where format is 'ogg' (the file as it is) or 'pcm' (decoded to the
+format of sound_cache.CAPS), and finally the offset of the index as 8
+ASCII hex digits. If the directory of sounds is there and does not match
+the index, the bank is not used; the sounds are read from the directory.
+
+To make a bank, run from the activity directory
+
+        python utils/sound_bank.py [--pcm] sounds/es
+
+Example usage:
+        bank = SoundBank('sounds/es')
+        bank.load()
+        data, format = bank.get('sounds/es/a.ogg')
+"""
+
+import os
+import sys
+import json
+import mmap
+
+import logging
+_logger = logging.getLogger('infused-activity')
+
+MAGIC = 'ICanRead sounds 1\n'
+
+
+def bank_path(directory):
+    """ Where the bank of a directory of sounds is kept """
+    return os.path.normpath(directory) + '.bank'
+
+
+class SoundBank:
+    """ The sounds of a directory, packed into one file and mapped """
+
+    def __init__(self, directory, path=None):
+        """ The bank of the sounds in directory, kept in path (by default,
+        next to the directory) """
+        self._directory = os.path.normpath(directory)
+        if path is None:
+            path = bank_path(directory)
+        self._filename = path
+        self._index = {}
+        self._map = None
+
+    def load(self):
+        """ Map the bank. Returns True if it can be used. """
+        if not os.path.exists(self._filename):
+            return False
+        try:
+            f = open(self._filename, 'rb')
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                f.close()
+            if data[0:len(MAGIC)] != MAGIC:
+                raise ValueError('not a sound bank')
+            start = int(data[-8:], 16)
+            index = json.loads(data[start:-8])
+        except (EnvironmentError, ValueError):
+            _logger.debug('ignoring bad sound bank %s', self._filename)
+            return False
+        if os.path.isdir(self._directory):
+            sources = _sources(self._directory)
+            if len(sources) != len(index) or [
+                name for name, (mtime, size, path) in sources.iteritems()
+                if name not in index or index[name][3:5] != [mtime, size]]:
+                _logger.debug('ignoring stale sound bank %s',
+                              self._filename)
+                data.close()
+                return False
+        self._map = data
+        self._index = index
+        return True
+
+    def entry(self, path):
+        """ The index entry of the sound at path, or None if it is not in
+        the bank """
+        if self._map is None or \
+           os.path.dirname(os.path.normpath(path)) != self._directory:
+            return None
+        return self._index.get(os.path.basename(path))
+
+    def get(self, path):
+        """ (data, format) of the sound at path, or None """
+        entry = self.entry(path)
+        if entry is None:
+            return None
+        offset, length, format = entry[0:3]
+        return self._map[offset:offset + length], format
+
+
+def _sources(directory):
+    """ name: (mtime, size, path) of the sounds in a directory, with
+    names in unicode (as they are in the index) """
+    sources = {}
+    for filename in os.listdir(directory):
+        if filename.lower().endswith('.ogg'):
+            path = os.path.join(directory, filename)
+            st = os.stat(path)
+            if isinstance(filename, str):
+                filename = filename.decode('utf-8')
+            sources[filename] = (st.st_mtime, st.st_size, path)
+    return sources
+
+
+def build(directory, path=None, pcm=False):
+    """ Pack the sounds in directory into path (by default, the bank of
+    the directory). If pcm, they are stored decoded (which needs gst). """
+    if path is None:
+        path = bank_path(directory)
+    if pcm:
+        from utils.sound_cache import decode
+    index = {}
+    f = open(path + '.tmp', 'wb')
+    f.write(MAGIC)
+    for name, (mtime, size, source) in sorted(_sources(directory).items()):
+        data = None
+        if pcm:
+            data = decode(source)
+        if data is None:
+            format = 'ogg'
+            data = open(source, 'rb').read()
+        else:
+            format = 'pcm'
+        index[name] = [f.tell(), len(data), format, mtime, size]
+        f.write(data)
+    start = f.tell()
+    json.dump(index, f)
+    f.write('%08x' % (start))
+    f.close()
+    os.rename(path + '.tmp', path)
+    return index
+
+
+def main(args):
+    pcm = '--pcm' in args
+    directories = [arg for arg in args if arg != '--pcm']
+    if len(directories) == 0:
+        print 'usage: python utils/sound_bank.py [--pcm] sounds/<lang> ...'
+        return 1
+    for directory in directories:
+        index = build(directory, pcm=pcm)
+        print '%s: %d sounds, %d bytes' % (
+            bank_path(directory), len(index),
+            os.path.getsize(bank_path(directory)))
+    return 0
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.dirname(
+                os.path.abspath(__file__))))
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+#Copyright (c) 2011 Walter Bender
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""
+sound_cache.py keeps the sounds of a level decoded to PCM, so that
+tapping a letter again plays it from memory rather than reading and
+decoding its Ogg file.
+
+Sounds are decoded on a worker thread, either when a level asks for
+them all up front (preload) or the first time one is played. Entries are
+keyed by path and modification time; the least recently played are
+dropped once the cache holds more than its budget of bytes. A sound too
+big for the budget is not cached: it is kept only until it is asked for.
+
+Every sound is decoded to the same format (CAPS), so any of them can be
+fed straight to an appsrc.
+
+If a SoundBank (see sound_bank.py) is given, the sounds in it are read
+from the bank rather than from their files: decoded sounds are played
+straight from it, others are decoded from it.
+
+Example usage:
+        cache = SoundCache(budget, bank)
+        cache.preload(paths)
+        data = cache.get(path)
+
+where get returns the samples if they are cached; if not, it returns None
+and starts decoding them.
+"""
+
+import gobject
+import os
+import threading
+import Queue
+
+from collections import OrderedDict
+
+import pygst
+import gst
+
+import logging
+_logger = logging.getLogger('infused-activity')
+
+gobject.threads_init()
+
+RATE = 22050
+CAPS = 'audio/x-raw-int,rate=%d,channels=1,width=16,depth=16,' \
+    'signed=true,endianness=1234' % (RATE)
+BYTES_PER_SECOND = RATE * 2
+# How long decoding a sound may take before we give up on it
+DECODE_TIMEOUT = 10
+
+
+def sequence(words):
+    """ Join sounds into one stream of samples, to be played without gaps.
+    words is a list of (sounds, pause): the samples of each sound of a
+    word (None for one that could not be decoded) and the seconds of
+    silence after it. Returns the samples and the (start, end) of each
+    word in seconds. """
+    samples = []
+    times = []
+    length = 0
+    for sounds, pause in words:
+        start = length
+        for data in sounds:
+            if data is not None:
+                samples.append(data)
+                length += len(data)
+        times.append((float(start) / BYTES_PER_SECOND,
+                      float(length) / BYTES_PER_SECOND))
+        silence = int(pause * RATE) * 2
+        samples.append('\0' * silence)
+        length += silence
+    return ''.join(samples), times
+
+
+def decode(path, data=None):
+    """ The samples of a sound file (or, if it is given, of the data read
+    from one) in CAPS format, or None. Samples are collected as the sink
+    gets them, so that an error part way through ends the wait (on the
+    bus) rather than leaving us blocked on a pull. """
+    if data is None:
+        source = 'filesrc'
+    else:
+        source = 'appsrc'
+    pipeline = gst.parse_launch(
+        '%s name=src ! decodebin2 ! audioconvert ! audioresample ! '
+        '%s ! appsink name=sink sync=false' % (source, CAPS))
+    src = pipeline.get_by_name('src')
+    sink = pipeline.get_by_name('sink')
+    buffers = []
+    sink.set_property('emit-signals', True)
+    sink.connect('new-buffer',
+                 lambda sink: buffers.append(sink.emit('pull-buffer').data))
+    if data is None:
+        src.set_property('location', path)
+    pipeline.set_state(gst.STATE_PLAYING)
+    if data is not None:
+        src.emit('push-buffer', gst.Buffer(data))
+        src.emit('end-of-stream')
+    message = pipeline.get_bus().timed_pop_filtered(
+        DECODE_TIMEOUT * gst.SECOND, gst.MESSAGE_EOS | gst.MESSAGE_ERROR)
+    pipeline.set_state(gst.STATE_NULL)
+    if message is not None and message.type == gst.MESSAGE_ERROR:
+        _logger.debug('error decoding %s: %s', path,
+                      message.parse_error()[0])
+    if message is None or message.type == gst.MESSAGE_ERROR or \
+       len(buffers) == 0:
+        _logger.debug('failed to decode %s', path)
+        return None
+    return ''.join(buffers)
+
+
+class SoundCache:
+    """ A memory (LRU) cache of decoded sounds, loaded in the background """
+
+    def __init__(self, budget, bank=None):
+        self._budget = budget
+        self._bank = bank
+        self._sounds = OrderedDict()  # (path, mtime): samples
+        self._bytes = 0
+        self._loading = set()
+        self._failed = set()
+        self._oversized = {}  # (path, mtime): samples, until asked for
+        self._too_big = set()
+        self._queue = Queue.Queue()
+        self._thread = None
+        self.hits = 0
+        self.bank_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, path):
+        """ The samples of the sound at path, if we have them. Otherwise
+        start decoding it and return None. """
+        key = self._key(path)
+        if key is None:
+            return None
+        if self._in_bank(path, 'pcm'):
+            self.bank_hits += 1
+            return self._bank.get(path)[0]
+        if key in self._failed:
+            return None
+        if key in self._oversized:
+            return self._oversized.pop(key)
+        if key in self._sounds:
+            self.hits += 1
+            data = self._sounds.pop(key)
+            self._sounds[key] = data
+            return data
+        self.misses += 1
+        self._start(key)
+        return None
+
+    def preload(self, paths):
+        """ Decode the sounds at paths (in the background), dropping any
+        that were waiting to be decoded for an older level """
+        try:
+            while True:
+                self._loading.discard(self._queue.get_nowait())
+        except Queue.Empty:
+            pass
+        self._oversized = {}
+        for path in paths:
+            key = self._key(path)
+            if key is not None and key not in self._sounds and \
+               key not in self._too_big and not self._in_bank(path, 'pcm'):
+                self._start(key)
+
+    def ready(self, paths):
+        """ Are all of the sounds at paths decoded (or known not to
+        decode)? Any that are not are decoded in the background. """
+        ready = True
+        for path in paths:
+            key = self._key(path)
+            if key is None or key in self._sounds or key in self._failed \
+               or key in self._oversized or self._in_bank(path, 'pcm'):
+                continue
+            self._start(key)
+            ready = False
+        return ready
+
+    def exists(self, path):
+        """ Is there a sound at path (in the bank or on disk)? """
+        return self._key(path) is not None
+
+    def stats(self):
+        """ Return (hits, bank hits, misses, evictions, entries, bytes) """
+        return (self.hits, self.bank_hits, self.misses, self.evictions,
+                len(self._sounds), self._bytes)
+
+    def _key(self, path):
+        if self._bank is not None:
+            entry = self._bank.entry(path)
+            if entry is not None:
+                return (path, entry[3])
+        try:
+            return (path, os.stat(path).st_mtime)
+        except OSError:
+            return None
+
+    def _in_bank(self, path, format):
+        """ Is the sound at path in the bank, in format? """
+        entry = self._bank is not None and self._bank.entry(path)
+        return bool(entry) and entry[2] == format
+
+    def _start(self, key):
+        """ Queue a sound for the worker thread """
+        if key in self._loading:
+            return
+        self._loading.add(key)
+        self._queue.put(key)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._worker)
+            self._thread.setDaemon(True)
+            self._thread.start()
+
+    def _worker(self):
+        """ Decode sounds as they are asked for """
+        while True:
+            key = self._queue.get()
+            path = key[0]
+            if self._in_bank(path, 'ogg'):
+                data = decode(path, self._bank.get(path)[0])
+            else:
+                data = decode(path)
+            gobject.idle_add(self._deliver, key, data)
+
+    def _deliver(self, key, data):
+        """ Cache a decoded sound, forgetting the least recently used. One
+        too big to cache is held for whoever asked for it. """
+        self._loading.discard(key)
+        if data is None:
+            self._failed.add(key)
+        if data is None or key in self._sounds:
+            return False
+        if len(data) > self._budget:
+            self._too_big.add(key)
+            self._oversized[key] = data
+            return False
+        self._sounds[key] = data
+        self._bytes += len(data)
+        while self._bytes > self._budget:
+            key, data = self._sounds.popitem(last=False)
+            self._bytes -= len(data)
+            self.evictions += 1
+        return False
@@ -27,10 +27,11 @@ sprites.py is a simple sprites library for managing graphics objects,
 'sprites', on a canvas. It manages multiple sprites with methods such
 as move, hide, set_layer, etc.
 
-There are two classes:
+There are three classes:
 
 class Sprites maintains a collection of sprites.
 class Sprite manages individual sprites within the collection.
+class SpritePool groups sprites that are released (and recycled) together.
 
 Example usage:
         # Import the classes into your program.
@@ -68,6 +69,12 @@ Example usage:
         # Now put my_sprite on top of your_sprite.
         my_sprite.set_layer(300)
 
+        # Batch up the redraws caused by a series of changes.
+        self.sprite_list.begin_damage()
+        my_sprite.move((x3, y3))
+        your_sprite.set_layer(400)
+        self.sprite_list.end_damage()
+
 # method for converting SVG to a gtk pixbuf
 def svg_str_to_pixbuf(svg_string):
     pl = gtk.gdk.PixbufLoader('svg')
@@ -77,13 +84,25 @@ def svg_str_to_pixbuf(svg_string):
     return pixbuf
 """
 
+import bisect
+from collections import OrderedDict
+
 import pygtk
 pygtk.require('2.0')
 import gtk
 import pango
 
+# Size of the cells of the grid used to find sprites by position
+CELL_SIZE = 64
+
+# Translation table from alpha values to hit-mask bytes: only fully
+# opaque pixels can be hit.
+_OPAQUE = ''.join([chr(int(a == 255)) for a in range(256)])
+
+_NO_MARGINS = (0, 0, 0, 0)
+
 
-class Sprites:
+class Sprites(object):
     """ A class for the list of sprites and everything they share in common """
 
     def __init__(self, canvas, area=None, gc=None):
@@ -96,7 +115,25 @@ class Sprites:
             self.area = area
             self.gc = gc
         self.cm = self.gc.get_colormap()
-        self.list = []
+        self._layers = {}  # layer: OrderedDict of its sprites, bottom up
+        self._order = []  # the layers in use, bottom up
+        self._hidden = set()  # sprites on layer 0
+        self._list = None  # the visible sprites in drawing order
+        self._damage = None
+        self._damage_depth = 0
+        self.damage_rects = 0  # rectangles marked for redraw
+        self.invalidations = 0  # invalidate calls made on the area
+        self._grid = {}  # (column, row): sprites that overlap the cell
+        self._sequence = 0
+
+    @property
+    def list(self):
+        """ The visible sprites, bottom to top """
+        if self._list is None:
+            self._list = []
+            for layer in self._order:
+                self._list.extend(self._layers[layer])
+        return self._list
 
     def get_sprite(self, i):
         """ Return a sprint from the array """
@@ -110,69 +147,225 @@ class Sprites:
         return(len(self.list))
 
     def append_to_list(self, spr):
-        """ Append a new sprite to the end of the list. """
-        self.list.append(spr)
+        """ Put a sprite on top of the others in its layer. """
+        if spr.layer == 0:
+            self._hidden.add(spr)
+            return
+        if spr.layer not in self._layers:
+            self._layers[spr.layer] = OrderedDict()
+            bisect.insort(self._order, spr.layer)
+        self._layers[spr.layer][spr] = True
+        self._list = None
+        self._add_to_grid(spr)
 
     def insert_in_list(self, spr, i):
-        """ Insert a sprite at position i. """
-        if i < 0:
-            self.list.insert(0, spr)
-        elif i > len(self.list) - 1:
-            self.list.append(spr)
-        else:
-            self.list.insert(i, spr)
+        """ Sprites are kept in layer order, so this is the same as
+        append_to_list; i is ignored. """
+        self.append_to_list(spr)
 
     def remove_from_list(self, spr):
         """ Remove a sprite from the list. """
-        if spr in self.list:
-            self.list.remove(spr)
+        if spr in self._hidden:
+            self._hidden.discard(spr)
+            return
+        bucket = self._layers.get(spr.layer)
+        if bucket is None or spr not in bucket:
+            return
+        del bucket[spr]
+        if len(bucket) == 0:
+            del self._layers[spr.layer]
+            self._order.remove(spr.layer)
+        self._list = None
+        self._remove_from_grid(spr)
+
+    def set_layer(self, spr, layer):
+        """ Move a sprite to the top of a layer; layer 0 hides it. """
+        self.remove_from_list(spr)
+        spr.layer = layer
+        self.append_to_list(spr)
+
+    def _add_to_grid(self, spr):
+        """ Index a sprite by the grid cells its rectangle covers. The
+        most recently added sprite on a layer is on top. """
+        self._remove_from_grid(spr)
+        self._sequence += 1
+        spr.sequence = self._sequence
+        self._place_in_grid(spr)
+
+    def _place_in_grid(self, spr):
+        """ Record which cells a sprite covers """
+        r = spr.rect
+        spr.cells = []
+        for i in range(r.x // CELL_SIZE, (r.x + r.width) // CELL_SIZE + 1):
+            for j in range(r.y // CELL_SIZE,
+                           (r.y + r.height) // CELL_SIZE + 1):
+                if (i, j) not in self._grid:
+                    self._grid[(i, j)] = set()
+                self._grid[(i, j)].add(spr)
+                spr.cells.append((i, j))
+
+    def _remove_from_grid(self, spr):
+        """ Forget the cells a sprite covered """
+        for cell in spr.cells:
+            self._grid[cell].discard(spr)
+            if len(self._grid[cell]) == 0:
+                del self._grid[cell]
+        spr.cells = []
+
+    def update_grid(self, spr):
+        """ A sprite has moved or changed size """
+        if len(spr.cells) > 0:
+            self._remove_from_grid(spr)
+            self._place_in_grid(spr)
+
+    def inval(self, rect):
+        """ Mark a rectangle for redraw """
+        self.damage_rects += 1
+        if self._damage is not None:
+            self._damage.union_with_rect(rect)
+        else:
+            self.invalidations += 1
+            self.area.invalidate_rect(rect, False)
+
+    def begin_damage(self):
+        """ Collect redraws into one region until end_damage """
+        if self._damage_depth == 0:
+            self._damage = gtk.gdk.Region()
+        self._damage_depth += 1
+
+    def end_damage(self, clip=None):
+        """ Invalidate the collected region, limited to the clip
+        rectangle (e.g., the visible part of a scrolled canvas) """
+        self._damage_depth -= 1
+        if self._damage_depth > 0:
+            return
+        region = self._damage
+        self._damage = None
+        if clip is not None:
+            region.intersect(gtk.gdk.region_rectangle(clip))
+        if not region.empty():
+            self.invalidations += 1
+            self.area.invalidate_region(region, False)
 
     def find_sprite(self, pos, alpha=True):
         """ Search based on (x, y) position. Return the 'top/first' one. """
-        list = self.list[:]
-        list.reverse()
-        for spr in list:
+        cell = (int(pos[0]) // CELL_SIZE, int(pos[1]) // CELL_SIZE)
+        if cell not in self._grid:
+            return None
+        candidates = sorted(self._grid[cell],
+                            key=lambda spr: (spr.layer, spr.sequence),
+                            reverse=True)
+        for spr in candidates:
             if spr.hit(pos):
-                if not alpha or spr.get_pixel(pos)[3] == 255:
+                if not alpha or spr.opaque(pos):
                     return spr
         return None
 
+    def stats(self):
+        """ Return (live sprites, bytes of pixbuf data they hold) """
+        sprites = self.list + list(self._hidden)
+        pixbufs = {}
+        for spr in sprites:
+            for img in spr.images:
+                if isinstance(img, gtk.gdk.Pixbuf):
+                    pixbufs[id(img)] = img.get_rowstride() * img.get_height()
+        return len(sprites), sum(pixbufs.values())
+
     def refresh(self, event):
         """ Handle expose event refresh """
-        self.redraw_sprites(event.area)
-
-    def redraw_sprites(self, area=None):
-        """ Redraw the sprites that intersect area. """
-        for spr in self.list:
-            if area == None:
-                spr.draw()
-            else:
-                intersection = spr.rect.intersect(area)
-                if intersection.width > 0 or intersection.height > 0:
+        self.redraw_sprites(event.area, event.region)
+
+    def redraw_sprites(self, area=None, region=None):
+        """ Redraw the sprites that intersect area (or the rectangles that
+        make up region), drawing only the parts inside them. Sprites on
+        layer 0 are hidden and are not in the list. """
+        if region is not None:
+            rects = region.get_rectangles()
+        else:
+            rects = [area]
+        for rect in rects:
+            for spr in self.list:
+                if rect == None:
                     spr.draw()
+                else:
+                    intersection = spr.rect.intersect(rect)
+                    if intersection.width > 0 and intersection.height > 0:
+                        spr.draw(intersection)
+
+
+class SpritePool(object):
+    """ The sprites owned by one thing (e.g., a level), released together.
+    Released sprites are kept and reused by the next call to new. """
+
+    def __init__(self, sprites):
+        self._sprites = sprites
+        self._live = []
+        self._free = []
+        self.recycled = 0
+
+    def new(self, x, y, image):
+        """ A sprite at (x, y), reusing a released one if we can """
+        if len(self._free) > 0:
+            spr = self._free.pop()
+            spr.reset(x, y, image)
+            self.recycled += 1
+        else:
+            spr = Sprite(self._sprites, x, y, image)
+        self._live.append(spr)
+        return spr
 
+    def release(self):
+        """ Hide every sprite in the pool and let go of their images """
+        for spr in self._live:
+            spr.release()
+        self._free.extend(self._live)
+        self._live = []
 
-class Sprite:
+    def stats(self):
+        """ Return (live sprites, free sprites, sprites recycled) """
+        return (len(self._live), len(self._free), self.recycled)
+
+
+class _Label(object):
+    """ The labels of a sprite and how to draw them """
+
+    __slots__ = ('text', 'scale', 'rescale', 'horiz_align', 'vert_align',
+                 'fd', 'color', 'margins')
+
+    def __init__(self):
+        self.text = []
+        self.scale = [12]
+        self.rescale = [True]
+        self.horiz_align = ["center"]
+        self.vert_align = ["middle"]
+        self.fd = None
+        self.color = None
+        self.margins = [0, 0, 0, 0]
+
+
+class Sprite(object):
     """ A class for the individual sprites """
 
+    # Most sprites hold one image and no label, so label state is only
+    # allocated by the first call that needs it.
+    __slots__ = ('_sprites', 'rect', 'layer', 'sequence', 'cells', 'images',
+                 '_offsets', '_hit_mask', '_label')
+
     def __init__(self, sprites, x, y, image):
         """ Initialize an individual sprite """
         self._sprites = sprites
+        self.reset(x, y, image)
+
+    def reset(self, x, y, image):
+        """ (Re)initialize a sprite that is not in the collection """
         self.rect = gtk.gdk.Rectangle(int(x), int(y), 0, 0)
-        self._scale = [12]
-        self._rescale = [True]
-        self._horiz_align = ["center"]
-        self._vert_align = ["middle"]
-        self._fd = None
-        self._bold = False
-        self._italic = False
-        self._color = None
-        self._margins = [0, 0, 0, 0]
+        self._label = None
         self.layer = 100
-        self.labels = []
+        self.sequence = 0  # position in the grid index
+        self.cells = []
+        self._hit_mask = None  # built from the base image when needed
         self.images = []
-        self._dx = []  # image offsets
-        self._dy = []
+        self._offsets = []  # (dx, dy) of each image
         self.set_image(image)
         if self._sprites is not None:
             self._sprites.append_to_list(self)
@@ -181,11 +374,11 @@ class Sprite:
         """ Add an image to the sprite. """
         while len(self.images) < i + 1:
             self.images.append(None)
-            self._dx.append(0)
-            self._dy.append(0)
+            self._offsets.append((0, 0))
         self.images[i] = image
-        self._dx[i] = dx
-        self._dy[i] = dy
+        self._offsets[i] = (dx, dy)
+        if i == 0:
+            self._hit_mask = None
         if isinstance(self.images[i], gtk.gdk.Pixbuf):
             w = self.images[i].get_width()
             h = self.images[i].get_height()
@@ -199,12 +392,16 @@ class Sprite:
                 self.rect.width = w + dx
             if h + dy > self.rect.height:
                 self.rect.height = h + dy
+        if self._sprites is not None:
+            self._sprites.update_grid(self)
 
     def move(self, pos, visible=True):
         """ Move to new (x, y) position """
         if visible:
             self.inval()
         self.rect.x, self.rect.y = int(pos[0]), int(pos[1])
+        if self._sprites is not None:
+            self._sprites.update_grid(self)
         if visible:
             self.inval()
 
@@ -214,6 +411,8 @@ class Sprite:
             self.inval()
         self.rect.x += int(pos[0])
         self.rect.y += int(pos[1])
+        if self._sprites is not None:
+            self._sprites.update_grid(self)
         if visible:
             self.inval()
 
@@ -239,14 +438,7 @@ class Sprite:
         """ Set the layer for a sprite """
         if self._sprites is None:
             return
-        self._sprites.remove_from_list(self)
-        self.layer = layer
-        for i in range(self._sprites.length_of_list()):
-            if layer < self._sprites.get_sprite(i).layer:
-                self._sprites.insert_in_list(self, i)
-                self.inval()
-                return
-        self._sprites.append_to_list(self)
+        self._sprites.set_layer(self, layer)
         self.inval()
 
     def set_label(self, new_label, i=0):
@@ -259,39 +451,59 @@ class Sprite:
             self.labels[i] = str(new_label)
         self.inval()
 
+    @property
+    def labels(self):
+        """ The text of each label """
+        if self._label is None:
+            return []
+        return self._label.text
+
+    def _margins(self):
+        """ [left, top, right, bottom] margins of the label """
+        if self._label is None:
+            return _NO_MARGINS
+        return self._label.margins
+
+    def _label_state(self):
+        """ The label state, allocated on first use """
+        if self._label is None:
+            self._label = _Label()
+        return self._label
+
     def set_margins(self, l=0, t=0, r=0, b=0):
         """ Set the margins for drawing the label """
-        self._margins = [l, t, r, b]
+        self._label_state().margins = [l, t, r, b]
 
     def _extend_labels_array(self, i):
         """ Append to the labels attribute list """
-        if self._fd is None:
+        label = self._label_state()
+        if label.fd is None:
             self.set_font('Sans')
-        if self._color is None:
-            self._color = self._sprites.cm.alloc_color('black')
+        if label.color is None:
+            label.color = self._sprites.cm.alloc_color('black')
         while len(self.labels) < i + 1:
             self.labels.append(" ")
-            self._scale.append(self._scale[0])
-            self._rescale.append(self._rescale[0])
-            self._horiz_align.append(self._horiz_align[0])
-            self._vert_align.append(self._vert_align[0])
+            label.scale.append(label.scale[0])
+            label.rescale.append(label.rescale[0])
+            label.horiz_align.append(label.horiz_align[0])
+            label.vert_align.append(label.vert_align[0])
 
     def set_font(self, font):
         """ Set the font for a label """
-        self._fd = pango.FontDescription(font)
+        self._label_state().fd = pango.FontDescription(font)
 
     def set_label_color(self, rgb):
         """ Set the font color for a label """
-        self._color = self._sprites.cm.alloc_color(rgb)
+        self._label_state().color = self._sprites.cm.alloc_color(rgb)
 
     def set_label_attributes(self, scale, rescale=True, horiz_align="center",
                              vert_align="middle", i=0):
         """ Set the various label attributes """
         self._extend_labels_array(i)
-        self._scale[i] = scale
-        self._rescale[i] = rescale
-        self._horiz_align[i] = horiz_align
-        self._vert_align[i] = vert_align
+        self._label.scale[i] = scale
+        self._label.rescale[i] = rescale
+        self._label.horiz_align[i] = horiz_align
+        self._label.vert_align[i] = vert_align
 
     def hide(self):
         """ Hide a sprite """
@@ -300,27 +512,48 @@ class Sprite:
         self.inval()
         self._sprites.remove_from_list(self)
 
+    def release(self):
+        """ Hide a sprite and drop its images so they can be freed """
+        self.hide()
+        self.images = []
+        self._offsets = []
+        self._hit_mask = None
+
     def inval(self):
         """ Force a region redraw by gtk """
         if self._sprites is None:
             return
-        self._sprites.area.invalidate_rect(self.rect, False)
+        self._sprites.inval(self.rect)
 
-    def draw(self):
-        """ Draw the sprite (and label) """
+    def draw(self, area=None):
+        """ Draw the sprite (and label), clipped to area if given """
         if self._sprites is None:
             return
         for i, img in enumerate(self.images):
+            if img is None:
+                continue
+            x = self.rect.x + self._offsets[i][0]
+            y = self.rect.y + self._offsets[i][1]
             if isinstance(img, gtk.gdk.Pixbuf):
-                self._sprites.area.draw_pixbuf(self._sprites.gc, img, 0, 0,
-                                               self.rect.x + self._dx[i],
-                                               self.rect.y + self._dy[i])
-            elif img is not None:
-                self._sprites.area.draw_drawable(self._sprites.gc, img, 0, 0,
-                                                 self.rect.x + self._dx[i],
-                                                 self.rect.y + self._dy[i],
-                                                 -1, -1)
-        if len(self.labels) > 0:
+                w, h = img.get_width(), img.get_height()
+            else:
+                w, h = img.get_size()
+            clip = gtk.gdk.Rectangle(x, y, w, h)
+            if area is not None:
+                clip = clip.intersect(area)
+                if clip.width <= 0 or clip.height <= 0:
+                    continue
+            if isinstance(img, gtk.gdk.Pixbuf):
+                self._sprites.area.draw_pixbuf(self._sprites.gc, img,
+                                               clip.x - x, clip.y - y,
+                                               clip.x, clip.y,
+                                               clip.width, clip.height)
+            else:
+                self._sprites.area.draw_drawable(self._sprites.gc, img,
+                                                 clip.x - x, clip.y - y,
+                                                 clip.x, clip.y,
+                                                 clip.width, clip.height)
+        if self._label is not None and len(self._label.text) > 0:
             self.draw_label()
 
     def hit(self, pos):
@@ -340,10 +573,12 @@ class Sprite:
         """ Draw the label based on its attributes """
         if self._sprites is None:
             return
-        my_width = self.rect.width - self._margins[0] - self._margins[2]
+        label = self._label
+        margins = self._margins()
+        my_width = self.rect.width - margins[0] - margins[2]
         if my_width < 0:
             my_width = 0
-        my_height = self.rect.height - self._margins[1] - self._margins[3]
+        my_height = self.rect.height - margins[1] - margins[3]
         for k in range(len(self.labels)):
             label_segments = self.labels[k].split('\n')
             for i in range(len(label_segments)):
@@ -351,44 +586,44 @@ class Sprite:
                     pango.parse_markup('<b><i>' + str(label_segments[i]) + '</i></b>',
                                                    accel_marker=u'\x00')
                                        )
-                self._fd.set_size(int(self._scale[k] * pango.SCALE))
-                pl.set_font_description(self._fd)
+                label.fd.set_size(int(label.scale[k] * pango.SCALE))
+                pl.set_font_description(label.fd)
                 w = pl.get_size()[0] / pango.SCALE
                 if w > my_width:
-                    if self._rescale[k]:
-                        self._fd.set_size(
-                            int(self._scale[k] * pango.SCALE * my_width / w))
-                        pl.set_font_description(self._fd)
+                    if label.rescale[k]:
+                        label.fd.set_size(
+                            int(label.scale[k] * pango.SCALE * my_width / w))
+                        pl.set_font_description(label.fd)
                         w = pl.get_size()[0] / pango.SCALE
                     else:
                         j = len(self.labels[k]) - 1
                         while(w > my_width and j > 0):
                             pl = self._sprites.canvas.create_pango_layout(
                               "…" + self.labels[k][len(self.labels[k]) - j:])
-                            self._fd.set_size(int(self._scale[i] * pango.SCALE))
-                            pl.set_font_description(self._fd)
+                            label.fd.set_size(int(label.scale[i] * pango.SCALE))
+                            pl.set_font_description(label.fd)
                             w = pl.get_size()[0] / pango.SCALE
                             j -= 1
-                if self._horiz_align[k] == "center":
-                    x = int(self.rect.x + self._margins[0] + (my_width - w) / 2)
-                elif self._horiz_align[k] == 'left':
-                    x = int(self.rect.x + self._margins[0])
+                if label.horiz_align[k] == "center":
+                    x = int(self.rect.x + margins[0] + (my_width - w) / 2)
+                elif label.horiz_align[k] == 'left':
+                    x = int(self.rect.x + margins[0])
                 else:  # right
                     x = int(self.rect.x + self.rect.width - \
-                            w - self._margins[2])
+                            w - margins[2])
                 h = pl.get_size()[1] / pango.SCALE
-                if self._vert_align[k] == "middle":
+                if label.vert_align[k] == "middle":
                     # yoff = int(len(label_segments) * h / 2.)
                     yoff = 0
-                    y = int(self.rect.y + self._margins[1] + \
+                    y = int(self.rect.y + margins[1] + \
                             (my_height - h) / 2 - yoff + i * h)
-                elif self._vert_align[k] == "top":
-                    y = int(self.rect.y + self._margins[1] + i * h)
+                elif label.vert_align[k] == "top":
+                    y = int(self.rect.y + margins[1] + i * h)
                 else:  # bottom
                     yoff = int(len(label_segments) * h)
                     y = int(self.rect.y + self.rect.height - \
-                            h - self._margins[3] - yoff + i * h)
-                self._sprites.gc.set_foreground(self._color)
+                            h - margins[3] - yoff + i * h)
+                self._sprites.gc.set_foreground(label.color)
                 self._sprites.area.draw_layout(self._sprites.gc, x, y, pl)
 
     def label_width(self):
@@ -396,8 +631,8 @@ class Sprite:
         max = 0
         for i in range(len(self.labels)):
             pl = self._sprites.canvas.create_pango_layout(self.labels[i])
-            self._fd.set_size(int(self._scale[i] * pango.SCALE))
-            pl.set_font_description(self._fd)
+            self._label.fd.set_size(int(self._label.scale[i] * pango.SCALE))
+            pl.set_font_description(self._label.fd)
             w = pl.get_size()[0] / pango.SCALE
             if w > max:
                 max = w
@@ -405,15 +640,42 @@ class Sprite:
 
     def label_safe_width(self):
         """ Return maximum width for a label """
-        return self.rect.width - self._margins[0] - self._margins[2]
+        return self.rect.width - self._margins()[0] - self._margins()[2]
 
     def label_safe_height(self):
         """ Return maximum height for a label """
-        return self.rect.height - self._margins[1] - self._margins[3]
+        return self.rect.height - self._margins()[1] - self._margins()[3]
 
     def label_left_top(self):
         """ Return the upper-left corner of the label safe zone """
-        return(self._margins[0], self._margins[1])
+        return(self._margins()[0], self._margins()[1])
+
+    def opaque(self, pos):
+        """ Is the base image opaque at (x, y)? """
+        if self._hit_mask is None:
+            self._hit_mask = self._make_hit_mask()
+        w, mask = self._hit_mask
+        x = pos[0] - self.rect.x
+        y = pos[1] - self.rect.y
+        if x < 0 or x >= w or y < 0 or y * w + x >= len(mask):
+            return False
+        return mask[y * w + x] == '\x01'
+
+    def _make_hit_mask(self):
+        """ (width, a byte per pixel: 1 where the base image is opaque) """
+        image = self.images[0]
+        if not isinstance(image, gtk.gdk.Pixbuf):
+            # Pixmaps have no alpha channel (see get_pixel).
+            return (0, '')
+        w = image.get_width()
+        h = image.get_height()
+        if not image.get_has_alpha():
+            return (w, '\x01' * (w * h))
+        rowstride = image.get_rowstride()
+        array = image.get_pixels()
+        alpha = [array[y * rowstride + 3:y * rowstride + w * 4:4]
+                 for y in range(h)]
+        return (w, ''.join(alpha).translate(_OPAQUE))
 
     def get_pixel(self, pos, i=0, mode='888'):
         """ Return the pixel at (x, y) """
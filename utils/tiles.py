@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+#Copyright (c) 2011 Walter Bender
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""
+tiles.py backs a tall canvas with a column of tile-sized pixmaps, each
+held by a sprite. Tiles are only allocated and painted where they can be
+seen, so the backing store grows with the screen, not with the content.
+
+Example usage:
+        tiles = TiledCanvas(sprites, window, width, 128, paint)
+        tiles.clear(content_height)
+        tiles.show(viewport)
+
+where paint(pixmap, gc, rect) draws the part of the content inside rect
+(in canvas coordinates) onto a pixmap whose origin is at (rect.x, rect.y).
+The tiles are white before they are painted.
+
+If content is given a key when it is shown (tiles.clear(height, key)),
+its painted tiles are kept, up to a memory budget, when other content
+replaces it; showing the same key again reuses them without painting.
+tiles.forget() drops them all.
+
+If only part of the content changes, tiles.repaint(rect) paints just
+that part of the tiles again.
+"""
+
+import gtk
+
+from collections import OrderedDict
+
+from utils.sprites import Sprite
+
+
+def _bytes_per_pixel(depth):
+    """ The memory a pixel of a pixmap of depth takes: 24-bit pixels are
+    stored in 32 bits, as X pads them """
+    if depth > 16:
+        return 4
+    elif depth > 8:
+        return 2
+    return 1
+
+
+class TiledCanvas(object):
+    """ A white canvas of any height, allocated a tile at a time """
+
+    def __init__(self, sprites, drawable, width, tile_height, paint, layer=1,
+                 keep=1, budget=0):
+        """ keep is how many rows of tiles to hold beyond the viewport;
+        budget is how many bytes of painted tiles to keep for content that
+        is not being shown. """
+        self._sprites = sprites
+        self._drawable = drawable
+        self._width = width
+        self._tile_height = tile_height
+        self._paint = paint
+        self._layer = layer
+        self._keep = keep
+        self._budget = budget
+        self._tiles = {}  # row: sprite
+        self._spares = []  # sprites of released tiles
+        self._pixmaps = []  # pixmaps of released tiles
+        self._rows = 1  # how many tiles are shown at a time
+        self._key = None  # of the content being shown
+        self._painted = {}  # row: pixmap already painted with the content
+        self._surfaces = OrderedDict()  # key: {row: pixmap}, oldest first
+        self._surface_bytes = 0
+        self.gc = None
+        self._bytes = _bytes_per_pixel(drawable.get_depth())
+        self.height = 0
+        self.painted = 0  # tiles painted
+        self.repainted = 0  # parts of tiles painted again
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def clear(self, height, key=None):
+        """ The content (and its height) has changed: discard the tiles, or
+        keep them if the old content had a key. """
+        if self._key is None:
+            for row in self._tiles.keys():
+                self._release(row)
+        else:
+            self._keep_surface()
+        self.height = height
+        self._key = key
+        if key is None:
+            return
+        if key in self._surfaces:
+            self.hits += 1
+            self._painted = self._surfaces.pop(key)
+            self._surface_bytes -= len(self._painted) * self._tile_bytes()
+        else:
+            self.misses += 1
+
+    def forget(self):
+        """ Drop the tiles kept for content that is not being shown, as
+        when none of it will be shown again """
+        for rows in self._surfaces.values():
+            for pixmap in rows.values():
+                self._free_pixmap(pixmap)
+        self._surfaces.clear()
+        self._surface_bytes = 0
+
+    def show(self, viewport=None, limit=None):
+        """ Make sure the tiles in the viewport (or, if there is none, the
+        whole content) are painted; release those far from it. If limit is
+        given, put no more than that many tiles up, those in the viewport
+        first. Returns True if there are more tiles to put up. """
+        if viewport is None:
+            top, bottom = 0, max(self.height, 1)
+        else:
+            top, bottom = viewport.y, viewport.y + viewport.height
+        first = top // self._tile_height
+        last = (bottom - 1) // self._tile_height
+        rows = range(first, last + 1) + \
+            range(last + 1, last + 1 + self._keep) + \
+            range(max(0, first - self._keep), first)
+        self._rows = len(rows)
+        for row in self._tiles.keys():
+            if row not in rows:
+                self._release(row)
+        for row in rows:
+            if row not in self._tiles:
+                if limit is not None and limit <= 0:
+                    return True
+                self._tiles[row] = self._tile(row)
+                if limit is not None:
+                    limit -= 1
+        return False
+
+    def repaint(self, rect):
+        """ The content inside rect (in canvas coordinates) has changed:
+        paint it again on the tiles that are up, and forget any tiles
+        kept for later that it touches. """
+        first = max(0, rect.y) // self._tile_height
+        last = (rect.y + rect.height - 1) // self._tile_height
+        for row in range(first, last + 1):
+            if row in self._painted:
+                self._free_pixmap(self._painted.pop(row))
+            if row not in self._tiles:
+                continue
+            tile = gtk.gdk.Rectangle(0, row * self._tile_height, self._width,
+                                     self._tile_height)
+            area = tile.intersect(rect)
+            if area.width <= 0 or area.height <= 0:
+                continue
+            pixmap = self._tiles[row].images[0]
+            clip = gtk.gdk.Rectangle(area.x, area.y - tile.y, area.width,
+                                     area.height)
+            self.gc.set_clip_rectangle(clip)
+            pixmap.draw_rectangle(self.gc, True, clip.x, clip.y, clip.width,
+                                  clip.height)
+            self._paint(pixmap, self.gc, tile)
+            self.gc.set_clip_rectangle(gtk.gdk.Rectangle(
+                    0, 0, self._width, self._tile_height))
+            self.repainted += 1
+            self._sprites.inval(area)
+
+    def stats(self):
+        """ Return (tiles allocated, tiles painted, bytes of pixmap) """
+        tiles = len(self._tiles) + len(self._pixmaps) + len(self._painted) + \
+            sum([len(rows) for rows in self._surfaces.values()])
+        return (tiles, self.painted, tiles * self._tile_bytes())
+
+    def cache_stats(self):
+        """ Return (hits, misses, evictions, bytes of kept tiles) """
+        return (self.hits, self.misses, self.evictions, self._surface_bytes)
+
+    def _tile_bytes(self):
+        """ The size of a tile pixmap """
+        return self._width * self._tile_height * self._bytes
+
+    def _keep_surface(self):
+        """ Keep the painted tiles of the content being shown """
+        rows = self._painted
+        for row in self._tiles.keys():
+            spr = self._tiles.pop(row)
+            rows[row] = spr.images[0]
+            spr.release()
+            self._spares.append(spr)
+        self._painted = {}
+        self._surfaces[self._key] = rows
+        self._surface_bytes += len(rows) * self._tile_bytes()
+        while self._surface_bytes > self._budget:
+            key, rows = self._surfaces.popitem(last=False)
+            self._surface_bytes -= len(rows) * self._tile_bytes()
+            self.evictions += 1
+            for pixmap in rows.values():
+                self._free_pixmap(pixmap)
+
+    def _free_pixmap(self, pixmap):
+        """ Keep enough pixmaps around to show a screenful of tiles """
+        if len(self._pixmaps) < self._rows:
+            self._pixmaps.append(pixmap)
+
+    def _tile(self, row):
+        """ Paint a tile (unless it was kept) and put it on the canvas """
+        rect = gtk.gdk.Rectangle(0, row * self._tile_height, self._width,
+                                 self._tile_height)
+        if row in self._painted:
+            pixmap = self._painted.pop(row)
+        else:
+            if len(self._pixmaps) > 0:
+                pixmap = self._pixmaps.pop()
+            else:
+                pixmap = gtk.gdk.Pixmap(self._drawable, self._width,
+                                        self._tile_height, -1)
+            if self.gc is None:
+                self.gc = pixmap.new_gc()
+                self.gc.set_foreground(
+                    self.gc.get_colormap().alloc_color('#FFFFFF'))
+            pixmap.draw_rectangle(self.gc, True, 0, 0, rect.width,
+                                  rect.height)
+            self._paint(pixmap, self.gc, rect)
+            self.painted += 1
+        if len(self._spares) > 0:
+            spr = self._spares.pop()
+            spr.reset(rect.x, rect.y, pixmap)
+        else:
+            spr = Sprite(self._sprites, rect.x, rect.y, pixmap)
+        spr.set_layer(self._layer)
+        return spr
+
+    def _release(self, row):
+        """ Take a tile off the canvas, keeping it for reuse """
+        spr = self._tiles.pop(row)
+        self._free_pixmap(spr.images[0])
+        spr.release()
+        self._spares.append(spr)